@@ -25,24 +25,50 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import re
 import sys
 import time
-import gzip
+import json
+import zlib
+import codecs
 import base64
 import shutil
 import struct
+import sqlite3
 import hashlib
+import email.utils
+import http.client
+import ssl
 import argparse
+import threading
+import queue
 import mimetypes
 import subprocess
+import concurrent.futures
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from filename_parser import tokenize_filename
+except ImportError:
+    tokenize_filename = None
 
 # ==== OpenSubtitles.org server settings =======================================
 
 # XML-RPC server domain for opensubtitles.org:
 if sys.version_info > (3, 0):
-    from xmlrpc.client import ServerProxy, Error
-    osd_server = ServerProxy('https://api.opensubtitles.org/xml-rpc')
+    from xmlrpc.client import ServerProxy, Transport, ProtocolError, Fault, Error
+    osd_server_url = 'https://api.opensubtitles.org/xml-rpc'
+
+# Compress (gzip) the requests sent to the server. Responses are always accepted compressed.
+osd_gzip_requests = False
 
 # You can use your opensubtitles.org VIP account to avoid "in-subtitles" advertisement and bypass download limits.
 # Be careful about your password security, it will be stored right here in plain text...
@@ -52,6 +78,16 @@ osd_username = 'ejammes'
 osd_password = 'jh3GPF5q'
 osd_language = 'en'
 
+# Requests quotas enforced by opensubtitles.org (see '429 Too Many Requests' errors).
+# VIP accounts can raise the daily download limit.
+osd_limit_requests = 40         # requests per 10 seconds
+osd_limit_requests_period = 10
+osd_limit_downloads = 200       # subtitles downloaded per 24 hours
+osd_limit_downloads_period = 86400
+
+# Maximum number of results returned by a single SearchSubtitles request.
+osd_search_result_limit = 500
+
 # ==== Language settings =======================================================
 
 # 1/ Change the search language by using any supported 3-letter (ISO639-2) language code:
@@ -77,6 +113,9 @@ opt_language_suffix_separator = '.'
 # Force downloading and storing UTF-8 encoded subtitles files.
 opt_force_utf8 = False
 
+# Number of subtitles downloaded with a single request.
+opt_download_batch_size = 20
+
 # ==== Search settings =========================================================
 
 # Subtitles search mode. Can be overridden at run time with '-s' argument.
@@ -86,6 +125,9 @@ opt_force_utf8 = False
 # - hash_and_filename (search using both methods)
 opt_search_mode = 'hash_then_filename'
 
+# Number of searches by hash (one per video file and language) sent in a single request.
+opt_search_batch_size = 20
+
 # Search and download a subtitles even if a subtitles file already exists.
 opt_search_overwrite = True
 
@@ -119,6 +161,32 @@ opt_selection_match    = 'auto'
 opt_selection_rating   = 'off'
 opt_selection_count    = 'off'
 
+# ==== Batch settings ==========================================================
+
+# Number of video files processed at the same time (hash, search and download).
+# All the workers share the same opensubtitles.org session. Can be overridden at run time with '-w' argument.
+opt_workers = 4
+
+# Directory used to keep state between runs (rate limits, hashes cache...).
+opt_cache_path = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'OpenSubtitlesDownload')
+
+# Maximum time (in seconds) spent waiting for the download quota, before giving up.
+opt_rate_limit_max_wait = 60
+
+# Keep the hashes of the video files in cache, so unchanged files are not read again.
+# Can be maintained at run time with '--warm-cache' and '--prune-cache' arguments.
+opt_hash_cache = True
+
+# Keep the search results in cache, so a video file searched again doesn't cost any request.
+# Time to live of the results (in seconds) and maximum number of results kept (least recently used are evicted).
+opt_search_cache = True
+opt_search_cache_ttl = 86400
+opt_search_cache_size = 10000
+
+# Record the progress of each video file in a journal, so an interrupted batch
+# can be resumed with the '--resume' argument, without redoing completed work.
+opt_journal = True
+
 # ==== Super Print =============================================================
 # priority: info, warning, error
 # title: only for zenity and kdialog messages
@@ -149,11 +217,207 @@ def superPrint(priority, title, message):
         # Print message
         print(">> " + message)
 
+# ==== Server connection =======================================================
+# All the requests share a pool of persistent (keep-alive) connections, so the
+# workers don't pay a new TCP and TLS handshake for each request.
+
+class PooledTransport(Transport):
+    """XML-RPC transport with a pool of keep-alive HTTP(S) connections, usable by several threads"""
+
+    def __init__(self, https=True, poolSize=4, gzipRequests=False, timeout=60):
+        super().__init__()
+        self.https = https
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.context = ssl.create_default_context() if https else None
+        self.pool = []
+        self.poolLock = threading.Lock()
+        if gzipRequests:
+            self.encode_threshold = 1024
+
+    def make_connection(self, host):
+        """Reuse an idle connection if possible, or open a new one"""
+        with self.poolLock:
+            while self.pool:
+                (poolHost, connection) = self.pool.pop()
+                if poolHost == host:
+                    return connection
+                connection.close()
+
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        if self.https:
+            return http.client.HTTPSConnection(chost, timeout=self.timeout, context=self.context)
+        return http.client.HTTPConnection(chost, timeout=self.timeout)
+
+    def releaseConnection(self, host, connection):
+        """Put back a connection in the pool, once its response has been entirely read"""
+        with self.poolLock:
+            if len(self.pool) < self.poolSize:
+                self.pool.append((host, connection))
+                return
+        connection.close()
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        connection = None
+        try:
+            connection = self.send_request(host, handler, request_body, verbose)
+            response = connection.getresponse()
+            if response.status == 200:
+                self.verbose = verbose
+                result = self.parse_response(response)
+                self.releaseConnection(host, connection)
+                return result
+        except Fault:
+            self.releaseConnection(host, connection)
+            raise
+        except Exception:
+            # The other idle connections are probably broken too (closed by the server?)
+            if connection:
+                connection.close()
+            self.close()
+            raise
+
+        # We got an error response, the connection is not reused
+        connection.close()
+        raise ProtocolError(host + handler, response.status, response.reason, dict(response.getheaders()))
+
+    def close(self):
+        with self.poolLock:
+            for (poolHost, connection) in self.pool:
+                connection.close()
+            self.pool = []
+
+osd_server = None
+
+# ==== Rate limiting ===========================================================
+# Every request goes through a sliding window log for each quota (40 requests
+# per 10s, 200 subtitles downloads per 24h): the time of each request and of each
+# download of the last period is kept, so that no window ever holds more than the
+# quota. The log is stored on disk so the quotas are honored across runs, and
+# across processes running at the same time.
+
+class RateLimitError(Exception):
+    """The request doesn't fit in the quotas in a reasonable time"""
+    pass
+
+class RateLimiter():
+    """Sliding window logs shared by all the workers, with their state kept on disk"""
+
+    def __init__(self, statePath):
+        self.statePath = statePath
+        self.quotas = {
+            'requests': (osd_limit_requests, osd_limit_requests_period),
+            'downloads': (osd_limit_downloads, osd_limit_downloads_period),
+        }
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(statePath), exist_ok=True)
+
+    def update(self, costs, partial=None, blockedUntil=None):
+        """Log the given costs if they fit in the quotas, return the delay to wait (0 if logged)
+        and the costs logged. The cost of the 'partial' quota is reduced to what is left of it, if needed.
+        A blocked-until time can be recorded, no request is allowed before it"""
+        with os.fdopen(os.open(self.statePath, os.O_RDWR | os.O_CREAT, 0o600), 'r+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+
+            now = time.time()
+            if blockedUntil:
+                state['blockedUntil'] = max(blockedUntil, state.get('blockedUntil', 0))
+            delay = max(0, state.get('blockedUntil', 0) - now) if costs.get('requests') else 0
+
+            costs = dict(costs)
+            logs = {}
+            for name, cost in costs.items():
+                (limit, period) = self.quotas[name]
+                log = state.get(name)
+                logs[name] = sorted(t for t in log if t > now - period) if isinstance(log, list) else []
+                if name == partial:
+                    cost = costs[name] = min(cost, max(1, limit - len(logs[name])))
+                if cost > limit:
+                    raise RateLimitError("%d %s exceed the quota of %d per %d seconds" % (cost, name, limit, period))
+                if len(logs[name]) + cost > limit:
+                    # Wait for the oldest entries to leave the window
+                    delay = max(delay, logs[name][len(logs[name]) + cost - limit - 1] + period - now)
+
+            if delay == 0:
+                for name, cost in costs.items():
+                    state[name] = logs[name] + [now] * cost
+            if delay == 0 or blockedUntil:
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+            return (delay, costs)
+
+    def wait(self, costs, partial=None, what="request"):
+        """Wait until the given costs fit in the quotas, and log them. Return the costs logged"""
+        with self.lock:
+            while True:
+                (delay, costs) = self.update(costs, partial)
+                if delay == 0:
+                    return costs
+                if delay > opt_rate_limit_max_wait:
+                    raise RateLimitError("%s limit reached, next %s possible in %d minutes" % (what.capitalize(), what, delay // 60 + 1))
+                time.sleep(delay)
+
+    def acquire(self):
+        """Wait until one request fits in the quotas"""
+        self.wait({'requests': 1})
+
+    def reserveDownloads(self, downloads):
+        """Wait until at least one download fits in the quota, and reserve as many of
+        the given number of downloads as possible. Return the number reserved"""
+        return self.wait({'downloads': downloads}, partial='downloads', what="download")['downloads']
+
+    def block(self, delay=None):
+        """The server refused a request, don't send anything else for the given delay (a whole period by default)"""
+        self.update({}, blockedUntil=time.time() + (delay or osd_limit_requests_period))
+
+rateLimiter = None
+
+def retryAfter(error):
+    """Delay asked by the 'Retry-After' header of a 429 error (in seconds or as a date), if any"""
+    for name, value in (error.headers or {}).items():
+        if name.lower() != 'retry-after':
+            continue
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def osdRequest(method, *params):
+    """Send an XML-RPC request within the quotas, retry once if it fails
+    (the downloads are reserved beforehand, a retry only takes a request)"""
+    for attempt in range(2):
+        rateLimiter.acquire()
+        try:
+            return getattr(osd_server, method)(*params)
+        except Exception as e:
+            if attempt > 0:
+                raise
+            if isinstance(e, ProtocolError) and e.errcode == 429:
+                # Quota used by another client, wait before sending anything else
+                rateLimiter.block(retryAfter(e))
+            else:
+                # We are already connected, the server may be momentary overloaded
+                time.sleep(3)
+
 # ==== Check file path & type ==================================================
 
-def checkFileValidity(path):
-    """Check mimetype and/or file extension to detect valid video file"""
-    if os.path.isfile(path) is False:
+def checkFileValidity(path, isFile=None):
+    """Check mimetype and/or file extension to detect valid video file
+    (isFile can be given when already known, from a folder scan)"""
+    if isFile is None:
+        isFile = os.path.isfile(path)
+    if isFile is False:
         return False
 
     fileMimeType, encoding = mimetypes.guess_type(path)
@@ -174,9 +438,12 @@ def checkFileValidity(path):
 
 # ==== Check for existing subtitles file =======================================
 
-def checkSubtitlesExists(path):
-    """Check if a subtitles already exists for the current file"""
-    extList = ['srt', 'sub', 'sbv', 'smi', 'ssa', 'ass', 'usf']
+subtitlesExtList = ['srt', 'sub', 'sbv', 'smi', 'ssa', 'ass', 'usf']
+
+def checkSubtitlesExists(path, subtitlesIndex=None):
+    """Check if a subtitles already exists for the current file
+    (using the index of the subtitles files found by a folder scan, if given)"""
+    extList = subtitlesExtList
     lngList = ['']
 
     if opt_language_suffix in ('on', 'auto'):
@@ -189,12 +456,55 @@ def checkSubtitlesExists(path):
     for ext in extList:
         for lng in lngList:
             subPath = path.rsplit('.', 1)[0] + lng + '.' + ext
-            if os.path.isfile(subPath) is True:
+            if (subPath in subtitlesIndex) if subtitlesIndex is not None else os.path.isfile(subPath):
                 superPrint("info", "Subtitles already downloaded!", "A subtitles file already exists for this file:\n<i>" + subPath + "</i>")
                 return True
 
     return False
 
+# ==== Folders scan ============================================================
+# Each folder is listed with a single os.scandir() pass (sub folders are listed
+# in parallel), which also builds an index of the subtitles files present:
+# checking for existing subtitles then doesn't cost any more system call.
+
+def scanFolder(path):
+    """List a folder: files, subtitles files and sub folders"""
+    fileList = []
+    subtitlesList = []
+    folderList = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folderList.append(entry.path)
+                elif entry.is_file():
+                    fileList.append(entry.path)
+                    if entry.name.rsplit('.', 1)[-1] in subtitlesExtList:
+                        subtitlesList.append(entry.path)
+    except OSError:
+        pass
+
+    return (fileList, subtitlesList, folderList)
+
+def scanFolders(pathList, recursive, executor):
+    """Scan folders (and their sub folders if recursive) using the executor workers.
+    Return the files found, and the index (set of paths) of the subtitles files"""
+    fileList = []
+    subtitlesIndex = set()
+
+    pending = set(executor.submit(scanFolder, path) for path in pathList)
+    while pending:
+        (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            (folderFileList, folderSubtitlesList, folderList) = future.result()
+            fileList += folderFileList
+            subtitlesIndex.update(folderSubtitlesList)
+            if recursive:
+                pending.update(executor.submit(scanFolder, path) for path in folderList)
+
+    return (sorted(fileList), subtitlesIndex)
+
 # ==== Hashing algorithm =======================================================
 # Info: https://trac.opensubtitles.org/projects/opensubtitles/wiki/HashSourceCodes
 # This particular implementation is coming from SubDownloader: https://subdownloader.net
@@ -234,9 +544,241 @@ def hashFile(path):
         superPrint("error", "I/O error!", "Input/Output error while generating hash for this file:\n<i>" + path + "</i>")
         return "IOError"
 
+def sumLongLongs(buf):
+    """Sum of the unsigned long long little endian values of a buffer, modulo 2^64"""
+    if numpy:
+        # Array reductions on uint64 wrap around, like the C implementations
+        return int(numpy.frombuffer(buf, dtype='<u8').sum(dtype=numpy.uint64))
+    if sys.byteorder == 'little':
+        return sum(memoryview(buf).cast('Q')) & 0xFFFFFFFFFFFFFFFF
+    return sum(struct.unpack("<%dQ" % (len(buf) // 8), buf)) & 0xFFFFFFFFFFFFFFFF
+
+def hashFileFast(path):
+    """Same hash as hashFile(), but the first and last 64k are read with pread()
+    and summed straight from the read buffers (using numpy when available)"""
+    if not hasattr(os, 'pread'):
+        return hashFile(path)
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            filesize = os.fstat(fd).st_size
+            if filesize < 65536 * 2:
+                superPrint("error", "File size error!", "File size error while generating hash for this file:\n<i>" + path + "</i>")
+                return "SizeError"
+
+            head = os.pread(fd, 65536, 0)
+            tail = os.pread(fd, 65536, filesize - 65536)
+        finally:
+            os.close(fd)
+
+        if len(head) != 65536 or len(tail) != 65536:
+            raise IOError("short read")
+
+        filehash = (filesize + sumLongLongs(head) + sumLongLongs(tail)) & 0xFFFFFFFFFFFFFFFF
+        return "%016x" % filehash
+
+    except (IOError, OSError):
+        superPrint("error", "I/O error!", "Input/Output error while generating hash for this file:\n<i>" + path + "</i>")
+        return "IOError"
+
+# ==== Hashes cache ============================================================
+# Hashes are stored in a SQLite database, keyed by device, inode, size and
+# modification time: a file that didn't change is never read again.
+
+class HashCache():
+    """Persistent cache of the video files hashes"""
+
+    def __init__(self, databasePath):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(databasePath), exist_ok=True)
+        self.database = sqlite3.connect(databasePath, check_same_thread=False)
+        self.database.execute('PRAGMA journal_mode=WAL')
+        self.database.execute('PRAGMA synchronous=NORMAL')
+        self.database.execute('CREATE TABLE IF NOT EXISTS hashes (device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER, path TEXT, hash TEXT, PRIMARY KEY (device, inode))')
+        self.database.commit()
+
+    def hash(self, path):
+        """Get the hash of a video file, from the cache if the file didn't change"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return hashFileFast(path)
+
+        with self.lock:
+            row = self.database.execute('SELECT hash FROM hashes WHERE device=? AND inode=? AND size=? AND mtime=?',
+                                        (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+        videoHash = hashFileFast(path)
+        if videoHash not in ('SizeError', 'IOError'):
+            with self.lock:
+                self.database.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                      (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, path, videoHash))
+                self.database.commit()
+        return videoHash
+
+    def prune(self):
+        """Remove the entries of the files that have been deleted or modified, return the number of entries removed"""
+        staleList = []
+        with self.lock:
+            for (device, inode, size, mtime, path) in self.database.execute('SELECT device, inode, size, mtime, path FROM hashes').fetchall():
+                try:
+                    stat = os.stat(path)
+                    if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) == (device, inode, size, mtime):
+                        continue
+                except OSError:
+                    pass
+                staleList.append((device, inode))
+            self.database.executemany('DELETE FROM hashes WHERE device=? AND inode=?', staleList)
+            self.database.commit()
+        return len(staleList)
+
+hashCache = None
+
+def hashFileCached(path):
+    """Produce a hash for a video file, using the hashes cache if enabled"""
+    if hashCache:
+        return hashCache.hash(path)
+    return hashFileFast(path)
+
+# ==== Search results cache ====================================================
+# SearchSubtitles results are stored in the same SQLite database than the hashes,
+# keyed by (moviehash, moviebytesize, sublanguageid, query) of each search.
+
+class SearchCache():
+    """Persistent cache of the search results, with a time to live and LRU eviction"""
+
+    def __init__(self, databasePath, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(databasePath), exist_ok=True)
+        self.database = sqlite3.connect(databasePath, check_same_thread=False)
+        self.database.execute('PRAGMA journal_mode=WAL')
+        self.database.execute('PRAGMA synchronous=NORMAL')
+        self.database.execute('CREATE TABLE IF NOT EXISTS searches (moviehash TEXT, moviebytesize TEXT, language TEXT, query TEXT, created REAL, accessed REAL, data TEXT, '
+                              'PRIMARY KEY (moviehash, moviebytesize, language, query))')
+        self.database.commit()
+        self.count = self.database.execute('SELECT COUNT(*) FROM searches').fetchone()[0]
+
+    def key(self, search):
+        return (search.get('moviehash', ''), search.get('moviebytesize', ''), search['sublanguageid'], search.get('query', ''))
+
+    def get(self, search):
+        """Get the results of a search, None if not in cache or expired"""
+        now = time.time()
+        with self.lock:
+            row = self.database.execute('SELECT created, data FROM searches WHERE moviehash=? AND moviebytesize=? AND language=? AND query=?', self.key(search)).fetchone()
+            if row is None:
+                return None
+            if row[0] + self.ttl < now:
+                self.database.execute('DELETE FROM searches WHERE moviehash=? AND moviebytesize=? AND language=? AND query=?', self.key(search))
+                self.database.commit()
+                self.count -= 1
+                return None
+            self.database.execute('UPDATE searches SET accessed=? WHERE moviehash=? AND moviebytesize=? AND language=? AND query=?', (now,) + self.key(search))
+            self.database.commit()
+        return json.loads(row[1])
+
+    def set(self, search, subtitlesData):
+        """Store the results of a search, evict the least recently used results if the cache is full"""
+        now = time.time()
+        with self.lock:
+            cursor = self.database.execute('DELETE FROM searches WHERE moviehash=? AND moviebytesize=? AND language=? AND query=?', self.key(search))
+            self.count -= cursor.rowcount
+            self.database.execute('INSERT INTO searches VALUES (?, ?, ?, ?, ?, ?, ?)', self.key(search) + (now, now, json.dumps(subtitlesData)))
+            self.count += 1
+            if self.count > self.size:
+                self.database.execute('DELETE FROM searches WHERE rowid IN (SELECT rowid FROM searches ORDER BY accessed LIMIT ?)', (self.count - self.size,))
+                self.count = self.size
+            self.database.commit()
+
+searchCache = None
+
+def searchSubtitles(subtitlesSearchList):
+    """Send a SearchSubtitles request, or get its results from the search results cache.
+    Only single searches are cached, results of several searches can't be told apart"""
+    if searchCache and len(subtitlesSearchList) == 1:
+        subtitlesData = searchCache.get(subtitlesSearchList[0])
+        if subtitlesData is not None:
+            return {'status': '200 OK', 'data': subtitlesData}
+
+    subtitlesResultList = osdRequest('SearchSubtitles', session['token'], subtitlesSearchList)
+
+    if searchCache and len(subtitlesSearchList) == 1 and subtitlesResultList.get('status') == '200 OK':
+        searchCache.set(subtitlesSearchList[0], subtitlesResultList.get('data') or [])
+
+    return subtitlesResultList
+
+# ==== Batch journal ===========================================================
+# Each step of each video file (hashed, searched, selected, downloaded) is
+# appended to a JSON lines journal. A resumed batch skips the completed steps.
+
+class Journal():
+    """Append-only journal of the progress of the video files of a batch"""
+
+    def __init__(self, journalPath, resume=False):
+        self.lock = threading.Lock()
+        self.videoList = {}
+        os.makedirs(os.path.dirname(journalPath), exist_ok=True)
+
+        if resume and os.path.isfile(journalPath):
+            with open(journalPath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        pass # interrupted while writing this entry
+
+        self.file = open(journalPath, 'a' if resume else 'w', encoding='utf-8')
+
+    def apply(self, entry):
+        if entry['state'] == 'hashed':
+            self.videoList[entry['video']] = {'hash': entry['hash'], 'size': entry['size'], 'mtime': entry['mtime'], 'downloaded': []}
+        elif entry['video'] in self.videoList:
+            video = self.videoList[entry['video']]
+            if entry['state'] == 'searched':
+                video['found'] = entry['found']
+            elif entry['state'] == 'selected':
+                video['selected'] = entry['downloads']
+            elif entry['state'] == 'downloaded':
+                video['downloaded'].append(entry['path'])
+
+    def record(self, videoPath, state, **data):
+        """Append a step of a video file to the journal"""
+        entry = dict(data, video=videoPath, state=state, time=time.time())
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.apply(entry)
+
+    def get(self, videoPath):
+        """Get the progress of a video file, None if unknown or if the file has been modified since"""
+        with self.lock:
+            video = self.videoList.get(videoPath)
+        try:
+            stat = os.stat(videoPath)
+        except OSError:
+            return None
+        if video is None or (video['size'], video['mtime']) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return video
+
+journal = None
+
+def hashVideo(videoPath):
+    """Produce the hash of a video file, and record it in the journal"""
+    videoHash = hashFileCached(videoPath)
+    if journal:
+        stat = os.stat(videoPath)
+        journal.record(videoPath, 'hashed', hash=videoHash, size=stat.st_size, mtime=stat.st_mtime_ns)
+    return videoHash
+
 # ==== GNOME selection window ==================================================
 
-def selectionGnome(subtitlesResultList):
+def selectionGnome(subtitlesResultList, videoTitle, videoFileName):
     """GNOME subtitles selection window using zenity"""
     subtitlesSelectedName = u''
     subtitlesSelectedIndex = -1
@@ -318,7 +860,7 @@ def selectionGnome(subtitlesResultList):
 
 # ==== KDE selection window ====================================================
 
-def selectionKde(subtitlesResultList):
+def selectionKde(subtitlesResultList, videoTitle, videoFileName):
     """KDE subtitles selection window using kdialog"""
     subtitlesSelectedName = u''
     subtitlesSelectedIndex = -1
@@ -365,7 +907,7 @@ def selectionKde(subtitlesResultList):
 
 # ==== CLI selection mode ======================================================
 
-def selectionCLI(subtitlesResultList):
+def selectionCLI(subtitlesResultList, videoTitle, videoFileName):
     """Command Line Interface, subtitles selection inside your current terminal"""
     subtitlesItemIndex = 0
     subtitlesItem = u''
@@ -417,10 +959,16 @@ def selectionCLI(subtitlesResultList):
 
 # ==== Automatic selection mode ================================================
 
-def selectionAuto(subtitlesResultList):
+def splitFileName(fileName):
+    """Split a file name into lower case words, memoized by the shared filename parser if available"""
+    if tokenize_filename:
+        return tokenize_filename(fileName)
+    return fileName.replace('-', '.').replace(' ', '.').replace('_', '.').lower().split('.')
+
+def selectionAuto(subtitlesResultList, videoTitle, videoFileName):
     """Automatic subtitles selection using filename match"""
 
-    videoFileParts = videoFileName.replace('-', '.').replace(' ', '.').replace('_', '.').lower().split('.')
+    videoFileParts = splitFileName(videoFileName)
     languageListReversed = list(reversed(languageList))
     maxScore = -1
 
@@ -432,11 +980,8 @@ def selectionAuto(subtitlesResultList):
         if subtitle['MatchedBy'] == 'moviehash':
             score += 1
         # points for filename mach
-        subFileParts = subtitle['SubFileName'].replace('-', '.').replace(' ', '.').replace('_', '.').lower().split('.')
-        for subPart in subFileParts:
-            for filePart in videoFileParts:
-                if subPart == filePart:
-                    score += 1
+        for subPart in splitFileName(subtitle['SubFileName']):
+            score += videoFileParts.count(subPart)
         if score > maxScore:
             maxScore = score
             subtitlesSelectedName = subtitle['SubFileName']
@@ -450,253 +995,200 @@ def selectionAuto(subtitlesResultList):
 def dependencyChecker():
     """Check the availability of tools used as dependencies"""
 
-    if opt_gui != 'cli':
-        for tool in ['gunzip', 'wget']:
-            path = shutil.which(tool)
-            if path is None:
-                superPrint("error", "Missing dependency!", "The <b>'" + tool + "'</b> tool is not available, please install it!")
-                return False
-
-    return True
-
-# ==============================================================================
-# ==== Main program (execution starts here) ====================================
-# ==============================================================================
-
-# ==== Exit code returned by the software. You can use them to improve scripting behaviours.
-# 0: Success, and subtitles downloaded
-# 1: Success, but no subtitles found or downloaded
-# 2: Failure
-
-ExitCode = 2
-
-# ==== File and language lists
-
-videoPathList = []
-languageList = []
-
-currentVideoPath = ""
-currentLanguage = ""
-
-# ==== Argument parsing
-
-# Get OpenSubtitlesDownload.py script absolute path
-if os.path.isabs(sys.argv[0]):
-    scriptPath = sys.argv[0]
-else:
-    scriptPath = os.getcwd() + "/" + str(sys.argv[0])
-
-# Setup ArgumentParser
-parser = argparse.ArgumentParser(prog='OpenSubtitlesDownload.py',
-                                 description='Automatically find and download the right subtitles for your favorite videos!',
-                                 formatter_class=argparse.RawTextHelpFormatter)
-
-parser.add_argument('--cli', help="Force CLI mode", action='store_true')
-parser.add_argument('-g', '--gui', help="Select the GUI you want from: auto, kde, gnome, cli (default: auto)")
-parser.add_argument('-l', '--lang', help="Specify the language in which the subtitles should be downloaded (default: eng).\nSyntax:\n-l eng,fre: search in both language\n-l eng -l fre: download both language", nargs='?', action='append')
-parser.add_argument('-i', '--skip', help="Skip search if an existing subtitles file is detected", action='store_true')
-parser.add_argument('-s', '--search', help="Search mode: hash, filename, hash_then_filename, hash_and_filename (default: hash_then_filename)")
-parser.add_argument('-t', '--select', help="Selection mode: manual, default, auto")
-parser.add_argument('-a', '--auto', help="Force automatic selection and download of the best subtitles found", action='store_true')
-parser.add_argument('-o', '--output', help="Override subtitles download path, instead of next their video file")
-parser.add_argument('-x', '--suffix', help="Force language code file suffix", action='store_true')
-parser.add_argument('-8', '--utf8', help="Force UTF-8 file download", action='store_true')
-parser.add_argument('-u', '--username', help="Set opensubtitles.org account username")
-parser.add_argument('-p', '--password', help="Set opensubtitles.org account password")
-parser.add_argument('searchPathList', help="The video file(s) or folder(s) for which subtitles should be searched and downloaded", nargs='+')
-
-# Parse arguments
-arguments = parser.parse_args()
-
-# Handle arguments
-if arguments.cli:
-    opt_gui = 'cli'
-if arguments.gui:
-    opt_gui = arguments.gui
-if arguments.search:
-    opt_search_mode = arguments.search
-if arguments.skip:
-    opt_search_overwrite = False
-if arguments.select:
-    opt_selection_mode = arguments.select
-if arguments.auto:
-    opt_selection_mode = 'auto'
-if arguments.output:
-    opt_output_path = arguments.output
-if arguments.lang:
-    opt_languages = arguments.lang
-if arguments.suffix:
-    opt_language_suffix = 'on'
-if arguments.utf8:
-    opt_force_utf8 = True
-if arguments.username and arguments.password:
-    osd_username = arguments.username
-    osd_password = arguments.password
-
-# GUI auto detection
-if opt_gui == 'auto':
-    # Note: "ps cax" only output the first 15 characters of the executable's names
-    ps = str(subprocess.Popen(['ps', 'cax'], stdout=subprocess.PIPE).communicate()[0]).split('\n')
-    for line in ps:
-        if ('gnome-session' in line) or ('cinnamon-sessio' in line) or ('mate-session' in line) or ('xfce4-session' in line):
-            opt_gui = 'gnome'
-            break
-        elif 'ksmserver' in line:
-            opt_gui = 'kde'
-            break
-
-# Sanitize some settings
-if opt_gui not in ['gnome', 'kde', 'cli']:
-    opt_gui = 'cli'
-    opt_search_mode = 'hash_then_filename'
-    opt_selection_mode = 'auto'
-    print("Unknown GUI, falling back to an automatic CLI mode")
-
-if opt_search_mode not in ['hash', 'filename', 'hash_then_filename', 'hash_and_filename']:
-    opt_search_mode = 'hash_then_filename'
-
-if opt_selection_mode not in ['manual', 'default', 'auto']:
-    opt_selection_mode = 'default'
-
-# ==== Check for Python 3
-
-if sys.version_info < (3, 0):
-    superPrint("error", "Wrong Python version",
-               "You need <b>Python 3</b> to use OpenSubtitlesDownload <b>v5</b>.\n" + \
-               "If you want to stick to Python 2, please continue using OpenSubtitlesDownload v4.")
-    sys.exit(2)
-
-# ==== Check for the necessary tools (must be done after GUI auto detection)
-
-if dependencyChecker() is False:
-    sys.exit(2)
-
-# ==== Get video paths, validate them, and if needed check if subtitles already exists
-
-for i in arguments.searchPathList:
-    path = os.path.abspath(i)
-    if os.path.isdir(path): # if it's a folder
-        if opt_gui == 'cli': # check all of the folder's (recursively)
-            for root, _, items in os.walk(path):
-                for item in items:
-                    localPath = os.path.join(root, item)
-                    if checkFileValidity(localPath):
-                        if opt_search_overwrite or (not opt_search_overwrite and not checkSubtitlesExists(localPath)):
-                            videoPathList.append(localPath)
-        else: # check all of the folder's files
-            for item in os.listdir(path):
-                localPath = os.path.join(path, item)
-                if checkFileValidity(localPath):
-                    if opt_search_overwrite or (not opt_search_overwrite and not checkSubtitlesExists(localPath)):
-                        videoPathList.append(localPath)
-    elif checkFileValidity(path): # if it is a file
-        if opt_search_overwrite or (not opt_search_overwrite and not checkSubtitlesExists(path)):
-            videoPathList.append(path)
-
-# If videoPathList is empty, abort!
-if not videoPathList:
-    sys.exit(1)
-
-# ==== Instances dispatcher ====================================================
-
-# The first video file will be processed by this instance
-currentVideoPath = videoPathList[0]
-videoPathList.pop(0)
-
-# The remaining file(s) are dispatched to new instance(s) of this script
-for videoPathDispatch in videoPathList:
-
-    # Pass settings
-    command = [ sys.executable, scriptPath, "-g", opt_gui, "-s", opt_search_mode, "-t", opt_selection_mode ]
-
-    for language in opt_languages:
-        command.append("-l")
-        command.append(language)
-
-    if not opt_search_overwrite:
-        command.append("-i")
-
-    if opt_language_suffix == 'on':
-        command.append("-x")
+    toolList = []
+    if opt_gui == 'gnome':
+        toolList = ['zenity']
+    elif opt_gui == 'kde':
+        toolList = ['kdialog']
 
-    if opt_force_utf8 == True:
-        command.append("-8")
+    for tool in toolList:
+        path = shutil.which(tool)
+        if path is None:
+            superPrint("error", "Missing dependency!", "The <b>'" + tool + "'</b> tool is not available, please install it!")
+            return False
 
-    if opt_output_path:
-        command.append("-o")
-        command.append(opt_output_path)
+    return True
 
-    if arguments.username and arguments.password:
-        command.append("-u")
-        command.append(arguments.username)
-        command.append("-p")
-        command.append(arguments.password)
+# ==== Batch search by hash ====================================================
 
-    # Pass file
-    command.append(videoPathDispatch)
+def searchSubtitlesBatch(videoList):
+    """Search subtitles by hash for many video files (list of hash and size) and
+    all the languages at once, in as few requests as possible.
+    Return the results of each search, in a {(videoHash, language): [subtitles]} dict"""
+    subtitlesSearchList = []
+    batchResultList = {}
 
-    # Do not spawn too many instances at once, avoid error '429 Too Many Requests'
-    time.sleep(2)
+    for (videoHash, videoSize) in sorted(set(videoList)):
+        for language in opt_languages:
+            search = {'sublanguageid':language, 'moviehash':videoHash, 'moviebytesize':str(videoSize)}
+            subtitlesData = searchCache.get(search) if searchCache else None
+            if subtitlesData is not None:
+                batchResultList[(videoHash, language)] = subtitlesData
+            else:
+                subtitlesSearchList.append(search)
 
-    if opt_gui == 'cli' and opt_selection_mode != 'auto':
-        # Synchronous call
-        process_videoDispatched = subprocess.call(command)
-    else:
-        # Asynchronous call
-        process_videoDispatched = subprocess.Popen(command)
+    batchList = [subtitlesSearchList[i:i+opt_search_batch_size] for i in range(0, len(subtitlesSearchList), opt_search_batch_size)]
 
-# ==== Search and download subtitles ===========================================
+    while batchList:
+        batch = batchList.pop()
+        try:
+            subtitlesResultList = osdRequest('SearchSubtitles', session['token'], batch)
+        except Exception:
+            # These video files will be searched one by one
+            continue
+
+        if subtitlesResultList.get('status') != '200 OK':
+            continue
+
+        subtitlesData = subtitlesResultList.get('data') or []
+        if len(subtitlesData) >= osd_search_result_limit and len(batch) > 1:
+            # Results may have been truncated, search again with smaller batches
+            batchList.append(batch[:len(batch)//2])
+            batchList.append(batch[len(batch)//2:])
+            continue
+
+        # Demultiplex the results, using the hash and the language of each search
+        for search in batch:
+            batchResultList[(search['moviehash'], search['sublanguageid'])] = []
+        for subtitle in subtitlesData:
+            for search in batch:
+                if subtitle['MovieHash'] == search['moviehash'] and subtitle['SubLanguageID'] in search['sublanguageid'].split(','):
+                    batchResultList[(search['moviehash'], search['sublanguageid'])].append(subtitle)
+
+        if searchCache:
+            for search in batch:
+                searchCache.set(search, batchResultList[(search['moviehash'], search['sublanguageid'])])
+
+    return batchResultList
+
+# ==== Download subtitles ======================================================
+
+def writeSubtitles(subtitlesData, subPath, subEncoding):
+    """Decode (base64), decompress (gzip) and write subtitles to disk chunk by chunk,
+    without any intermediate copy of the whole file. Return the number of bytes written"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        decoder = codecs.getincrementaldecoder(subEncoding)('replace')
+        encoder = codecs.getincrementalencoder('utf-8' if opt_force_utf8 else subEncoding)('replace')
+    except LookupError:
+        # Unknown encoding, the subtitles are written as is
+        decoder = None
+
+    byteswritten = 0
+    with open(subPath, 'wb') as f:
+        for i in range(0, len(subtitlesData), 65536): # base64 chunks must be a multiple of 4 characters
+            buf = decompressor.decompress(base64.b64decode(subtitlesData[i:i+65536]))
+            if i + 65536 >= len(subtitlesData):
+                buf += decompressor.flush()
+            if decoder:
+                buf = encoder.encode(decoder.decode(buf, final=(i + 65536 >= len(subtitlesData))))
+            byteswritten += f.write(buf)
+
+    return byteswritten
+
+def downloadSubtitlesBatch(downloadList):
+    """Download subtitles (list of download dicts) using a single request, return the failed downloads"""
+    subIDList = sorted(set(download['id'] for download in downloadList))
+    try:
+        downloads = rateLimiter.reserveDownloads(len(subIDList))
+    except RateLimitError as e:
+        superPrint("error", "Download limit reached!", str(e) + "\n\nYour download limits are <b>" + str(osd_limit_downloads) + " subtitles per 24h</b>.")
+        return downloadList
+
+    # Only what is left of the download quota is downloaded now, the other subtitles fail
+    downloadLeftList = []
+    if downloads < len(subIDList):
+        superPrint("warning", "Download limit reached!", "Only " + str(downloads) + " of " + str(len(subIDList)) + " subtitles can be downloaded now." + \
+                   "\n\nYour download limits are <b>" + str(osd_limit_downloads) + " subtitles per 24h</b>.")
+        subIDList = subIDList[:downloads]
+        downloadLeftList = [download for download in downloadList if download['id'] not in subIDList]
+        downloadList = [download for download in downloadList if download['id'] in subIDList]
 
-try:
-    # ==== Connection to OpenSubtitlesDownload
     try:
-        session = osd_server.LogIn(osd_username, hashlib.md5(osd_password[0:32].encode('utf-8')).hexdigest(), osd_language, 'opensubtitles-download 5.1')
+        downloadResult = osdRequest('DownloadSubtitles', session['token'], subIDList)
     except Exception:
-        # Retry once after a delay (could just be a momentary overloaded server?)
-        time.sleep(3)
-        try:
-            session = osd_server.LogIn(osd_username, osd_password, osd_language, 'opensubtitles-download 5.1')
-        except Exception:
-            superPrint("error", "Connection error!", "Unable to reach OpenSubtitles.org servers!\n\nPlease check:\n" + \
-                       "- Your Internet connection status\n" + \
-                       "- www.opensubtitles.org availability\n" + \
-                       "The subtitles search and download service is powered by <a href=\"https://opensubtitles.org\">opensubtitles.org</a>.\n" + \
-                       "Be sure to donate if you appreciate the service provided!")
-            sys.exit(2)
+        return downloadList + downloadLeftList
 
-    # Login not accepted?
-    if session['status'] != '200 OK':
-        if session['status'] == '401 Unauthorized':
-            superPrint("error", "Connection error!", "OpenSubtitles.org servers refused the connection: <b>" + session['status'] + "</b>.\n\n" + \
-                       "- You MUST use a valid OpenSubtitles.org account!\n" + \
-                       "- Check out <a href=\"https://github.com/emericg/OpenSubtitlesDownload/wiki/Log-in-with-a-registered-user\">how and why</a> on our wiki page")
-        else:
-            superPrint("error", "Connection error!", "OpenSubtitles.org servers refused the connection: <b>" + session['status'] + "</b>.\n\nPlease check:\n" + \
-                       "- www.opensubtitles.org availability\n" + \
-                       "- Your download limits (200 subtitles per 24h, 40 subtitles per 10s)\n\n" + \
-                       "The subtitles search and download service is powered by <a href=\"https://opensubtitles.org\">opensubtitles.org</a>.\n" + \
-                       "Be sure to donate if you appreciate the service provided!")
-        sys.exit(2)
+    subtitlesDataList = {}
+    for item in downloadResult.get('data') or []:
+        subtitlesDataList[str(item['idsubtitlefile'])] = item['data']
 
-    # ==== Count languages selected for this search
-    for language in opt_languages:
-        languageList += list(language.split(','))
+    downloadFailedList = downloadLeftList
+    for download in downloadList:
+        print(">> Downloading '" + download['language'] + "' subtitles for '" + download['title'] + "'")
+        subtitlesData = subtitlesDataList.get(str(download['id']))
+        try:
+            if not subtitlesData or writeSubtitles(subtitlesData, download['path'], download['encoding']) == 0:
+                downloadFailedList.append(download)
+            elif journal:
+                journal.record(download['video'], 'downloaded', path=download['path'])
+        except (OSError, ValueError, zlib.error):
+            downloadFailedList.append(download)
+
+    return downloadFailedList
+
+# ==== Selection on the main thread ============================================
+
+selectionQueue = queue.Queue()
+selectionClosed = False
+selectionQueueLock = threading.Lock()
+
+def selectionMainThread(selectionFunction, subtitlesResultList, videoTitle, videoFileName):
+    """Run a selection window or prompt on the main thread, which is the one receiving Ctrl-C,
+    and wait for the user's choice"""
+    if threading.current_thread() is threading.main_thread():
+        return selectionFunction(subtitlesResultList, videoTitle, videoFileName)
+
+    request = concurrent.futures.Future()
+    with selectionQueueLock:
+        if selectionClosed:
+            return ("", -1)
+        selectionQueue.put((request, selectionFunction, (subtitlesResultList, videoTitle, videoFileName)))
+    return request.result()
+
+def selectionServe(futureList):
+    """Yield the futures as they complete, running the selections asked by the workers meanwhile"""
+    global selectionClosed
+
+    pending = set(futureList)
+    try:
+        while pending:
+            try:
+                (request, selectionFunction, args) = selectionQueue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            else:
+                try:
+                    request.set_result(selectionFunction(*args))
+                except BaseException:
+                    request.set_result(("", -1))
+                    raise
+
+            done = set(future for future in pending if future.done())
+            pending -= done
+            yield from done
+    finally:
+        # Cancel the selections asked after an interruption, so that no worker waits forever
+        with selectionQueueLock:
+            selectionClosed = True
+            while not selectionQueue.empty():
+                selectionQueue.get()[0].set_result(("", -1))
+
+# ==== Process a video file ====================================================
+
+selectionLock = threading.Lock()
+
+def processVideo(currentVideoPath, videoHash, batchResultList):
+    """Search and download subtitles for a single video file, using the shared session
+    and the results of the batch search by hash (if any).
+    Return 0 if subtitles have been found (1 otherwise) and the list of subtitles to download"""
+    global opt_selection_hi, opt_selection_language, opt_selection_match, opt_selection_rating, opt_selection_count
 
-    languageCount_search = len(languageList)
     languageCount_results = 0
-
-    if opt_language_suffix == 'auto' and languageCount_search > 1:
-        opt_language_suffix = 'on'
-
-    if opt_language_suffix_size == 'auto':
-        languagePrefixSize = 0
-        for language in languageList:
-            languagePrefixSize += len(language)
-        opt_language_suffix_size = (languagePrefixSize // languageCount_search)
+    downloadList = []
 
     # ==== Get file hash, size and name
     videoTitle = ''
-    videoHash = hashFile(currentVideoPath)
     videoSize = os.path.getsize(currentVideoPath)
     videoFileName = os.path.basename(currentVideoPath)
 
@@ -704,23 +1196,24 @@ try:
     for currentLanguage in opt_languages:
         subtitlesSearchList = []
         subtitlesResultList = {}
+        subtitlesHashResultList = batchResultList.get((videoHash, currentLanguage))
 
-        if opt_search_mode in ('hash', 'hash_then_filename', 'hash_and_filename'):
+        if opt_search_mode in ('hash', 'hash_then_filename', 'hash_and_filename') and subtitlesHashResultList is None:
             subtitlesSearchList.append({'sublanguageid':currentLanguage, 'moviehash':videoHash, 'moviebytesize':str(videoSize)})
         if opt_search_mode in ('filename', 'hash_and_filename'):
             subtitlesSearchList.append({'sublanguageid':currentLanguage, 'query':videoFileName})
 
         ## Primary search
-        try:
-            subtitlesResultList = osd_server.SearchSubtitles(session['token'], subtitlesSearchList)
-        except Exception:
-            # Retry once after a delay (we are already connected, the server may be momentary overloaded)
-            time.sleep(3)
+        if subtitlesSearchList:
             try:
-                subtitlesResultList = osd_server.SearchSubtitles(session['token'], subtitlesSearchList)
+                subtitlesResultList = searchSubtitles(subtitlesSearchList)
             except Exception:
                 superPrint("error", "Search error!", "Unable to reach opensubtitles.org servers!\n<b>Search error</b>")
 
+        # Results of the batch search by hash come first
+        if subtitlesHashResultList is not None:
+            subtitlesResultList['data'] = subtitlesHashResultList + (subtitlesResultList.get('data') or [])
+
         #if (opt_search_mode == 'hash_and_filename'):
         #    TODO Cleanup duplicate between moviehash and filename results
 
@@ -730,14 +1223,9 @@ try:
             subtitlesSearchList.append({'sublanguageid':currentLanguage, 'query':videoFileName})
             subtitlesResultList.clear()
             try:
-                subtitlesResultList = osd_server.SearchSubtitles(session['token'], subtitlesSearchList)
+                subtitlesResultList = searchSubtitles(subtitlesSearchList)
             except Exception:
-                # Retry once after a delay (we are already connected, the server may be momentary overloaded)
-                time.sleep(3)
-                try:
-                    subtitlesResultList = osd_server.SearchSubtitles(session['token'], subtitlesSearchList)
-                except Exception:
-                    superPrint("error", "Search error!", "Unable to reach opensubtitles.org servers!\n<b>Search error</b>")
+                superPrint("error", "Search error!", "Unable to reach opensubtitles.org servers!\n<b>Search error</b>")
 
         ## Parse the results of the XML-RPC query
         if ('data' in subtitlesResultList) and (subtitlesResultList['data']):
@@ -771,34 +1259,35 @@ try:
             if not subName:
                 if opt_selection_mode == 'auto':
                     # Automatic subtitles selection
-                    (subName, subIndex) = selectionAuto(subtitlesResultList)
+                    (subName, subIndex) = selectionAuto(subtitlesResultList, videoTitle, videoFileName)
                 else:
-                    # Go through the list of subtitles and handle 'auto' settings activation
-                    for item in subtitlesResultList['data']:
-                        if opt_selection_match == 'auto' and opt_search_mode == 'hash_and_filename':
-                            opt_selection_match = 'on'
-                        if opt_selection_language == 'auto' and languageCount_search > 1:
-                            opt_selection_language = 'on'
-                        if opt_selection_hi == 'auto' and item['SubHearingImpaired'] == '1':
-                            opt_selection_hi = 'on'
-                        if opt_selection_rating == 'auto' and item['SubRating'] != '0.0':
-                            opt_selection_rating = 'on'
-                        if opt_selection_count == 'auto':
-                            opt_selection_count = 'on'
-
-                    # Spaw selection window
-                    if opt_gui == 'gnome':
-                        (subName, subIndex) = selectionGnome(subtitlesResultList)
-                    elif opt_gui == 'kde':
-                        (subName, subIndex) = selectionKde(subtitlesResultList)
-                    else: # CLI
-                        (subName, subIndex) = selectionCLI(subtitlesResultList)
+                    # Only one selection window at a time, the other workers keep searching meanwhile
+                    with selectionLock:
+                        # Go through the list of subtitles and handle 'auto' settings activation
+                        for item in subtitlesResultList['data']:
+                            if opt_selection_match == 'auto' and opt_search_mode == 'hash_and_filename':
+                                opt_selection_match = 'on'
+                            if opt_selection_language == 'auto' and languageCount_search > 1:
+                                opt_selection_language = 'on'
+                            if opt_selection_hi == 'auto' and item['SubHearingImpaired'] == '1':
+                                opt_selection_hi = 'on'
+                            if opt_selection_rating == 'auto' and item['SubRating'] != '0.0':
+                                opt_selection_rating = 'on'
+                            if opt_selection_count == 'auto':
+                                opt_selection_count = 'on'
+
+                        # Spaw selection window, from the main thread
+                        if opt_gui == 'gnome':
+                            (subName, subIndex) = selectionMainThread(selectionGnome, subtitlesResultList, videoTitle, videoFileName)
+                        elif opt_gui == 'kde':
+                            (subName, subIndex) = selectionMainThread(selectionKde, subtitlesResultList, videoTitle, videoFileName)
+                        else: # CLI
+                            (subName, subIndex) = selectionMainThread(selectionCLI, subtitlesResultList, videoTitle, videoFileName)
 
             # At this point a subtitles should be selected
             if subName:
                 # Prepare download
                 subID = subtitlesResultList['data'][subIndex]['IDSubtitleFile']
-                subURL = subtitlesResultList['data'][subIndex]['SubDownloadLink']
                 subEncoding = subtitlesResultList['data'][subIndex]['SubEncoding']
                 subLangName = subtitlesResultList['data'][subIndex]['LanguageName']
                 subPath = ''
@@ -818,84 +1307,355 @@ try:
 
                     subPath = subPath.rsplit('.', 1)[0] + subLangId + '.' + subtitlesResultList['data'][subIndex]['SubFormat']
 
-                # Escape non-alphanumeric characters from the subtitles download path
-                if opt_gui != 'cli':
-                    subPath = re.escape(subPath)
-                    subPath = subPath.replace('"', '\\"')
-                    subPath = subPath.replace("'", "\\'")
-                    subPath = subPath.replace('`', '\\`')
-
-                # Make sure we are downloading an UTF8 encoded file
-                if opt_force_utf8:
-                    downloadPos = subURL.find("download/")
-                    if downloadPos > 0:
-                        subURL = subURL[:downloadPos+9] + "subencoding-utf8/" + subURL[downloadPos+9:]
-
-                ## Download and unzip the selected subtitles
-                if opt_gui == 'gnome':
-                    process_subtitlesDownload = subprocess.call("(wget -q -O - " + subURL + " | gunzip > " + subPath + ") 2>&1"
-                                                                + ' | (zenity --auto-close --progress --pulsate --title="Downloading subtitles, please wait..." --text="Downloading <b>'
-                                                                + subtitlesResultList['data'][subIndex]['LanguageName'] + '</b> subtitles for <b>' + videoTitle + '</b>...")', shell=True)
-                elif opt_gui == 'kde':
-                    process_subtitlesDownload = subprocess.call("(wget -q -O - " + subURL + " | gunzip > " + subPath + ") 2>&1", shell=True)
-                else: # CLI
-                    print(">> Downloading '" + subtitlesResultList['data'][subIndex]['LanguageName'] + "' subtitles for '" + videoTitle + "'")
-                    process_subtitlesDownload = 1
-
-                    downloadResult = osd_server.DownloadSubtitles(session['token'], [subID])
-                    if ('data' in downloadResult) \
-                            and (downloadResult['data']) \
-                            and (len(downloadResult['data']) > 0) \
-                            and ('data' in downloadResult['data'][0]) \
-                            and (downloadResult['data'][0]['data']):
-                        decodedBytes = base64.b64decode(downloadResult['data'][0]['data'])
-                        decompressed = gzip.decompress(decodedBytes)
-                        if len(decompressed) > 0:
-                            decodedStr = str(decompressed, subEncoding, 'replace')
-                            byteswritten = open(subPath, 'w', encoding=subEncoding, errors='replace').write(decodedStr)
-                            if byteswritten > 0:
-                                process_subtitlesDownload = 0
-
-                # If an error occurs, say so
-                if process_subtitlesDownload != 0:
-                    superPrint("error", "Subtitling error!",
-                               "An error occurred while downloading or writing <b>" + subtitlesResultList['data'][subIndex]['LanguageName'] + "</b> subtitles for <b>" + videoTitle + "</b>.")
-                    osd_server.LogOut(session['token'])
-                    sys.exit(2)
-
-                # Use a secondary tool after a successful download?
-                #process_subtitlesDownload = subprocess.call("(custom_command" + " " + subPath + ") 2>&1", shell=True)
+                ## Queue the selected subtitles, they are downloaded once all the video files are processed
+                downloadList.append({'id': subID, 'path': subPath, 'encoding': subEncoding,
+                                     'language': subLangName, 'title': videoTitle, 'video': currentVideoPath})
+
+    if journal:
+        journal.record(currentVideoPath, 'searched', found=(languageCount_results > 0))
+        journal.record(currentVideoPath, 'selected', downloads=downloadList)
 
     ## Print a message if no subtitles have been found, for any of the languages
     if languageCount_results == 0:
         superPrint("info", "No subtitles available :-(", '<b>No subtitles found</b> for this video:\n<i>' + videoFileName + '</i>')
-        ExitCode = 1
-    else:
-        ExitCode = 0
-
-except KeyboardInterrupt:
-    sys.exit(1)
-
-except (OSError, IOError, RuntimeError, AttributeError, TypeError, NameError, KeyError):
-    # Do not warn about remote disconnection # bug/feature of python 3.5?
-    if "http.client.RemoteDisconnected" in str(sys.exc_info()[0]):
-        sys.exit(ExitCode)
-
-    # An unknown error occur, let's apologize before exiting
-    superPrint("error", "Unexpected error!",
-               "OpenSubtitlesDownload encountered an <b>unknown error</b>, sorry about that...\n\n" + \
-               "Error: <b>" + str(sys.exc_info()[0]).replace('<', '[').replace('>', ']') + "</b>\n" + \
-               "Line: <b>" + str(sys.exc_info()[-1].tb_lineno) + "</b>\n\n" + \
-               "Just to be safe, please check:\n" + \
-               "- www.opensubtitles.org availability\n" + \
-               "- Your Internet connection status\n" + \
-               "- Your download limits (200 subtitles per 24h, 40 subtitles per 10s)\n" + \
-               "- That are using the latest version of this software ;-)")
-
-except Exception:
-    # Catch unhandled exceptions but do not spawn an error window
-    print("Unexpected error (line " + str(sys.exc_info()[-1].tb_lineno) + "): " + str(sys.exc_info()[0]))
-
-# Disconnect from opensubtitles.org server, then exit
-if session and session['token']: osd_server.LogOut(session['token'])
-sys.exit(ExitCode)
+        return (1, downloadList)
+
+    return (0, downloadList)
+
+# ==============================================================================
+# ==== Main program (execution starts here) ====================================
+# ==============================================================================
+
+if __name__ == '__main__':
+    # ==== Exit code returned by the software. You can use them to improve scripting behaviours.
+    # 0: Success, and subtitles downloaded
+    # 1: Success, but no subtitles found or downloaded
+    # 2: Failure
+
+    ExitCode = 2
+
+    # ==== File and language lists
+
+    videoPathList = []
+    languageList = []
+
+
+    # ==== Argument parsing
+
+    # Setup ArgumentParser
+    parser = argparse.ArgumentParser(prog='OpenSubtitlesDownload.py',
+                                     description='Automatically find and download the right subtitles for your favorite videos!',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--cli', help="Force CLI mode", action='store_true')
+    parser.add_argument('-g', '--gui', help="Select the GUI you want from: auto, kde, gnome, cli (default: auto)")
+    parser.add_argument('-l', '--lang', help="Specify the language in which the subtitles should be downloaded (default: eng).\nSyntax:\n-l eng,fre: search in both language\n-l eng -l fre: download both language", nargs='?', action='append')
+    parser.add_argument('-i', '--skip', help="Skip search if an existing subtitles file is detected", action='store_true')
+    parser.add_argument('-s', '--search', help="Search mode: hash, filename, hash_then_filename, hash_and_filename (default: hash_then_filename)")
+    parser.add_argument('-t', '--select', help="Selection mode: manual, default, auto")
+    parser.add_argument('-a', '--auto', help="Force automatic selection and download of the best subtitles found", action='store_true')
+    parser.add_argument('-o', '--output', help="Override subtitles download path, instead of next their video file")
+    parser.add_argument('-x', '--suffix', help="Force language code file suffix", action='store_true')
+    parser.add_argument('-8', '--utf8', help="Force UTF-8 file download", action='store_true')
+    parser.add_argument('-u', '--username', help="Set opensubtitles.org account username")
+    parser.add_argument('-p', '--password', help="Set opensubtitles.org account password")
+    parser.add_argument('-w', '--workers', help="Number of video files processed at the same time (default: 4)", type=int)
+    parser.add_argument('--resume', help="Resume the previous batch, skipping the video files already completed", action='store_true')
+    parser.add_argument('--no-cache', help="Do not use the hashes and search results caches", action='store_true')
+    parser.add_argument('--warm-cache', help="Only hash the video files, to fill the hashes cache", action='store_true')
+    parser.add_argument('--prune-cache', help="Remove the deleted or modified files from the hashes cache", action='store_true')
+    parser.add_argument('searchPathList', help="The video file(s) or folder(s) for which subtitles should be searched and downloaded", nargs='*')
+
+    # Parse arguments
+    arguments = parser.parse_args()
+
+    if not arguments.searchPathList and not arguments.prune_cache:
+        parser.error("the following arguments are required: searchPathList")
+
+    # Handle arguments
+    if arguments.cli:
+        opt_gui = 'cli'
+    if arguments.gui:
+        opt_gui = arguments.gui
+    if arguments.search:
+        opt_search_mode = arguments.search
+    if arguments.skip:
+        opt_search_overwrite = False
+    if arguments.select:
+        opt_selection_mode = arguments.select
+    if arguments.auto:
+        opt_selection_mode = 'auto'
+    if arguments.output:
+        opt_output_path = arguments.output
+    if arguments.lang:
+        opt_languages = arguments.lang
+    if arguments.suffix:
+        opt_language_suffix = 'on'
+    if arguments.utf8:
+        opt_force_utf8 = True
+    if arguments.workers and arguments.workers > 0:
+        opt_workers = arguments.workers
+    if arguments.no_cache:
+        opt_hash_cache = False
+        opt_search_cache = False
+    if arguments.username and arguments.password:
+        osd_username = arguments.username
+        osd_password = arguments.password
+
+    # GUI auto detection
+    if opt_gui == 'auto':
+        # Note: "ps cax" only output the first 15 characters of the executable's names
+        ps = str(subprocess.Popen(['ps', 'cax'], stdout=subprocess.PIPE).communicate()[0]).split('\n')
+        for line in ps:
+            if ('gnome-session' in line) or ('cinnamon-sessio' in line) or ('mate-session' in line) or ('xfce4-session' in line):
+                opt_gui = 'gnome'
+                break
+            elif 'ksmserver' in line:
+                opt_gui = 'kde'
+                break
+
+    # Sanitize some settings
+    if opt_gui not in ['gnome', 'kde', 'cli']:
+        opt_gui = 'cli'
+        opt_search_mode = 'hash_then_filename'
+        opt_selection_mode = 'auto'
+        print("Unknown GUI, falling back to an automatic CLI mode")
+
+    if opt_search_mode not in ['hash', 'filename', 'hash_then_filename', 'hash_and_filename']:
+        opt_search_mode = 'hash_then_filename'
+
+    if opt_selection_mode not in ['manual', 'default', 'auto']:
+        opt_selection_mode = 'default'
+
+    # ==== Check for Python 3
+
+    if sys.version_info < (3, 0):
+        superPrint("error", "Wrong Python version",
+                   "You need <b>Python 3</b> to use OpenSubtitlesDownload <b>v5</b>.\n" + \
+                   "If you want to stick to Python 2, please continue using OpenSubtitlesDownload v4.")
+        sys.exit(2)
+
+    # ==== Check for the necessary tools (must be done after GUI auto detection)
+
+    if dependencyChecker() is False:
+        sys.exit(2)
+
+    # ==== Open the hashes and search results caches
+
+    if opt_hash_cache or arguments.warm_cache or arguments.prune_cache:
+        hashCache = HashCache(os.path.join(opt_cache_path, 'cache.sqlite'))
+
+    if opt_search_cache and opt_search_cache_size > 0:
+        searchCache = SearchCache(os.path.join(opt_cache_path, 'cache.sqlite'), opt_search_cache_ttl, opt_search_cache_size)
+
+    if arguments.prune_cache:
+        print(">> " + str(hashCache.prune()) + " entries removed from the hashes cache")
+        if not arguments.searchPathList:
+            sys.exit(0)
+
+    # ==== Get video paths, validate them, and if needed check if subtitles already exists
+
+    folderPathList = []
+    filePathList = []
+
+    for i in arguments.searchPathList:
+        path = os.path.abspath(i)
+        if os.path.isdir(path): # if it's a folder
+            folderPathList.append(path)
+        elif checkFileValidity(path): # if it is a file
+            filePathList.append(path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opt_workers) as executor:
+        # CLI: check all of the folder's files (recursively), GUI: check all of the folder's files
+        (fileList, subtitlesIndex) = scanFolders(folderPathList, opt_gui == 'cli', executor)
+        for localPath in fileList:
+            if checkFileValidity(localPath, isFile=True):
+                videoPathList.append(localPath)
+        videoPathList += filePathList
+
+        # Index the subtitles files next to the video files given directly
+        if not opt_search_overwrite and filePathList:
+            subtitlesIndex.update(scanFolders(set(os.path.dirname(path) for path in filePathList), False, executor)[1])
+
+    if not opt_search_overwrite:
+        videoPathList = [path for path in videoPathList if not checkSubtitlesExists(path, subtitlesIndex)]
+
+    # If videoPathList is empty, abort!
+    if not videoPathList:
+        sys.exit(1)
+
+    # Only fill the hashes cache?
+    if arguments.warm_cache:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=opt_workers) as executor:
+            videoHashList = list(executor.map(hashCache.hash, videoPathList))
+        print(">> " + str(len(videoHashList)) + " video files hashed")
+        sys.exit(0)
+
+    # ==== Search and download subtitles ===========================================
+
+    session = None
+    executor = None
+
+    try:
+        osd_server = ServerProxy(osd_server_url, transport=PooledTransport(https=osd_server_url.startswith('https'), poolSize=opt_workers, gzipRequests=osd_gzip_requests))
+        rateLimiter = RateLimiter(os.path.join(opt_cache_path, 'ratelimit.json'))
+
+        # ==== Connection to OpenSubtitlesDownload
+        try:
+            rateLimiter.acquire()
+            session = osd_server.LogIn(osd_username, hashlib.md5(osd_password[0:32].encode('utf-8')).hexdigest(), osd_language, 'opensubtitles-download 5.1')
+        except Exception:
+            # Retry once after a delay (could just be a momentary overloaded server?)
+            time.sleep(3)
+            try:
+                rateLimiter.acquire()
+                session = osd_server.LogIn(osd_username, osd_password, osd_language, 'opensubtitles-download 5.1')
+            except Exception:
+                superPrint("error", "Connection error!", "Unable to reach OpenSubtitles.org servers!\n\nPlease check:\n" + \
+                           "- Your Internet connection status\n" + \
+                           "- www.opensubtitles.org availability\n" + \
+                           "The subtitles search and download service is powered by <a href=\"https://opensubtitles.org\">opensubtitles.org</a>.\n" + \
+                           "Be sure to donate if you appreciate the service provided!")
+                sys.exit(2)
+
+        # Login not accepted?
+        if session['status'] != '200 OK':
+            if session['status'] == '401 Unauthorized':
+                superPrint("error", "Connection error!", "OpenSubtitles.org servers refused the connection: <b>" + session['status'] + "</b>.\n\n" + \
+                           "- You MUST use a valid OpenSubtitles.org account!\n" + \
+                           "- Check out <a href=\"https://github.com/emericg/OpenSubtitlesDownload/wiki/Log-in-with-a-registered-user\">how and why</a> on our wiki page")
+            else:
+                superPrint("error", "Connection error!", "OpenSubtitles.org servers refused the connection: <b>" + session['status'] + "</b>.\n\nPlease check:\n" + \
+                           "- www.opensubtitles.org availability\n" + \
+                           "- Your download limits (200 subtitles per 24h, 40 subtitles per 10s)\n\n" + \
+                           "The subtitles search and download service is powered by <a href=\"https://opensubtitles.org\">opensubtitles.org</a>.\n" + \
+                           "Be sure to donate if you appreciate the service provided!")
+            sys.exit(2)
+
+        # ==== Count languages selected for this search
+        for language in opt_languages:
+            languageList += list(language.split(','))
+
+        languageCount_search = len(languageList)
+
+        if opt_language_suffix == 'auto' and languageCount_search > 1:
+            opt_language_suffix = 'on'
+
+        if opt_language_suffix_size == 'auto':
+            languagePrefixSize = 0
+            for language in languageList:
+                languagePrefixSize += len(language)
+            opt_language_suffix_size = (languagePrefixSize // languageCount_search)
+
+        # ==== Dispatch the video files to the workers, all sharing the same session
+        videoResultList = []
+        downloadList = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=opt_workers)
+
+        if opt_journal:
+            journal = Journal(os.path.join(opt_cache_path, 'journal.jsonl'), arguments.resume)
+
+        # Skip the video files already completed by a previous run, resume their downloads
+        videoProcessList = []
+        videoHashList = []
+        for videoPath in videoPathList:
+            video = journal.get(videoPath) if journal else None
+            if video is None:
+                videoProcessList.append(videoPath)
+                videoHashList.append(None)
+            elif 'found' not in video or 'selected' not in video:
+                videoProcessList.append(videoPath)
+                videoHashList.append(video['hash'])
+            else:
+                videoResultList.append(0 if video['found'] else 1)
+                downloadList += [download for download in video['selected'] if download['path'] not in video['downloaded']]
+
+        # Hash all the video files, then search them by hash in batches
+        hashFutureList = {}
+        for (index, videoPath) in enumerate(videoProcessList):
+            if videoHashList[index] is None:
+                hashFutureList[index] = executor.submit(hashVideo, videoPath)
+        for (index, future) in hashFutureList.items():
+            videoHashList[index] = future.result()
+
+        batchResultList = {}
+
+        if opt_search_mode in ('hash', 'hash_then_filename', 'hash_and_filename'):
+            videoList = []
+            for (videoPath, videoHash) in zip(videoProcessList, videoHashList):
+                if videoHash not in ('SizeError', 'IOError'):
+                    videoList.append((videoHash, os.path.getsize(videoPath)))
+            batchResultList = searchSubtitlesBatch(videoList)
+
+        futureList = {}
+        for (videoPath, videoHash) in zip(videoProcessList, videoHashList):
+            futureList[executor.submit(processVideo, videoPath, videoHash, batchResultList)] = videoPath
+
+        for future in selectionServe(futureList):
+            try:
+                (videoResult, videoDownloadList) = future.result()
+            except Exception:
+                # Don't abort the batch because of a single video file
+                superPrint("error", "Unexpected error!", "OpenSubtitlesDownload encountered an <b>unknown error</b> with this video:\n<i>" + futureList[future] + "</i>\n\n" + \
+                           "Error: <b>" + str(sys.exc_info()[1]).replace('<', '[').replace('>', ']') + "</b>")
+                (videoResult, videoDownloadList) = (2, [])
+            videoResultList.append(videoResult)
+            downloadList += videoDownloadList
+
+        # ==== Download all the selected subtitles, grouped in as few requests as possible
+        process_subtitlesDownload = None
+        if opt_gui == 'gnome' and downloadList:
+            process_subtitlesDownload = subprocess.Popen(['zenity', '--progress', '--pulsate', '--auto-close', '--title=Downloading subtitles, please wait...',
+                                                          '--text=Downloading <b>' + str(len(downloadList)) + '</b> subtitles...'], stdin=subprocess.PIPE)
+
+        downloadBatchList = [downloadList[i:i+opt_download_batch_size] for i in range(0, len(downloadList), opt_download_batch_size)]
+        downloadFailedList = sum(executor.map(downloadSubtitlesBatch, downloadBatchList), [])
+
+        if process_subtitlesDownload:
+            process_subtitlesDownload.communicate(b'100\n')
+
+        # If an error occurs, say so
+        for download in downloadFailedList:
+            superPrint("error", "Subtitling error!",
+                       "An error occurred while downloading or writing <b>" + download['language'] + "</b> subtitles for <b>" + download['title'] + "</b>.")
+            videoResultList.append(2)
+
+        if 2 in videoResultList:
+            ExitCode = 2
+        elif 0 in videoResultList:
+            ExitCode = 0
+        else:
+            ExitCode = 1
+
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    except (OSError, IOError, RuntimeError, AttributeError, TypeError, NameError, KeyError):
+        # Do not warn about remote disconnection # bug/feature of python 3.5?
+        if "http.client.RemoteDisconnected" in str(sys.exc_info()[0]):
+            sys.exit(ExitCode)
+
+        # An unknown error occur, let's apologize before exiting
+        superPrint("error", "Unexpected error!",
+                   "OpenSubtitlesDownload encountered an <b>unknown error</b>, sorry about that...\n\n" + \
+                   "Error: <b>" + str(sys.exc_info()[0]).replace('<', '[').replace('>', ']') + "</b>\n" + \
+                   "Line: <b>" + str(sys.exc_info()[-1].tb_lineno) + "</b>\n\n" + \
+                   "Just to be safe, please check:\n" + \
+                   "- www.opensubtitles.org availability\n" + \
+                   "- Your Internet connection status\n" + \
+                   "- Your download limits (200 subtitles per 24h, 40 subtitles per 10s)\n" + \
+                   "- That are using the latest version of this software ;-)")
+
+    except Exception:
+        # Catch unhandled exceptions but do not spawn an error window
+        print("Unexpected error (line " + str(sys.exc_info()[-1].tb_lineno) + "): " + str(sys.exc_info()[0]))
+
+    finally:
+        # Do not start the pending video files, the running ones are finished
+        if executor: executor.shutdown(wait=True, cancel_futures=True)
+
+    # Disconnect from opensubtitles.org server, then exit
+    if session and session['token']:
+        rateLimiter.acquire()
+        osd_server.LogOut(session['token'])
+    sys.exit(ExitCode)
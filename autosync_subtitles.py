@@ -1,14 +1,13 @@
 #!/usr/bin/env python
 import os
-import re
 import sys
-import glob
 import argparse
 # import configparser
 import logging
 from datetime import datetime
 import subprocess
 from termcolor import colored
+from library_catalog import LibraryCatalog, default_catalog_file
 # import autosubsync
 import ffsubsync
 
@@ -36,6 +35,7 @@ if __name__ == '__main__':
         # options
         parser = argparse.ArgumentParser(description='automatic subtitles sync')
         parser.add_argument('extensions', nargs="*", help='movie file extensions')
+        parser.add_argument('-c', '--catalog',   metavar='catalog',   type=str,  help='library catalog file (default=%s)' % default_catalog_file)
         parser.add_argument('-r', '--recursive', dest='recursive',action='store_true', help='recurse in sub folders')
         parser.add_argument('-l', '--log',       dest='log',      action='store_true', help='log to file')
         parser.add_argument('-v', '--verbose',   dest='verbose',  action='store_true', help='verbose mode')
@@ -59,29 +59,16 @@ if __name__ == '__main__':
             fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             logger.addHandler(fileHandler)
 
-        file_list = []
-        for movie_extension in args.extensions:
-            file_pattern = "*.%s"  % movie_extension
-            if args.recursive:
-                file_pattern = "**/%s" % file_pattern
+        # the movie files and their sidecar subtitles are listed in a single walk, without reading the media
+        catalog = LibraryCatalog(args.catalog)
 
-            file_list += glob.glob(file_pattern, recursive=args.recursive)
-
-        for filepath in sorted(file_list):
+        for filepath in catalog.scan(args.extensions, args.recursive, probe=False, subtitle_extensions=default_subtitle_extensions):
             logging.debug("%s" % filepath)
             filepath_without_ext = os.path.splitext(filepath)[0]
 
-            subtitle_list = {}
-
-            for subtitle_extension in default_subtitle_extensions:
-                subtitle_file_pattern = "%s.*.%s" % (glob.escape(filepath_without_ext), subtitle_extension)
-                for subtitle_filepath in glob.glob(subtitle_file_pattern):
-                    logging.debug("found file: %s" % subtitle_filepath)
-                    m = re.match(r"%s.([a-z]{2,3}).%s" % (re.escape(filepath_without_ext), subtitle_extension), subtitle_filepath)
-                    if (m):
-                        lang = m.group(1)
-                        logging.debug("subtitle found : %s (lang=%s)" % (subtitle_filepath, lang))
-                        subtitle_list[lang] = subtitle_filepath
+            subtitle_list = catalog.get_sidecars(filepath)
+            for (lang, subtitle_filepath) in subtitle_list.items():
+                logging.debug("subtitle found : %s (lang=%s)" % (subtitle_filepath, lang))
 
             if len(subtitle_list) > 0:
                 output_file = filepath_without_ext + ".mux.mkv"
@@ -1,16 +1,13 @@
 #!/usr/bin/env python
 import os
-import re
 import sys
-import glob
 import argparse
 # import configparser
 import logging
 from datetime import datetime
 from termcolor import colored
 # from ffprobe import FFProbe
-import subprocess
-import json
+from library_catalog import LibraryCatalog, default_catalog_file
 
 ############################
 # configuration
@@ -18,54 +15,10 @@ import json
 
 default_movie_extensions = [ "mkv", "mp4", "avi" ]
 default_languages_to_keep = [ "eng", "fre" ]
-ffprobe_stream_types = {
-    "audio": "a",
-    "subtitles": "s"
-}
+default_max_workers = 8             # concurrent ffprobe processes
 
 # configFile = "replay_data.ini"
 
-############################
-# functions
-############################
-
-def lower_keys(x):
-    if isinstance(x, list):
-        return [lower_keys(v) for v in x]
-    elif isinstance(x, dict):
-        return dict((k.lower(), lower_keys(v)) for k, v in x.items())
-    else:
-        return x
-
-def ffprobe_get_stream_languages(filename: str, stream_type: str):
-    stream_language_list = None
-
-    cmd = ["ffprobe", filename, "-select_streams", ffprobe_stream_types[stream_type], "-show_entries", "stream_tags=language", "-of", "json", "-v", "quiet"]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=os.getcwd())
-    proc_output = proc.stdout.read()
-    
-    ret = lower_keys(json.loads(proc_output))
-
-    if "streams" in ret.keys():
-        stream_language_list= []
-
-        for stream in ret["streams"]:
-            if "tags" in stream and "language" in stream["tags"]:
-                stream_language_list.append(stream["tags"]["language"])
-
-    return stream_language_list
-
-
-def ffprobe(filename: str):
-    stream_language_list = {}
-
-    for stream_type in ["audio", "subtitles"]:
-        substream_list =  ffprobe_get_stream_languages(filename, stream_type)
-        if substream_list:
-            stream_language_list[stream_type] = substream_list
-
-    return stream_language_list
-
 ############################
 # main
 ############################
@@ -78,6 +31,8 @@ if __name__ == '__main__':
         parser = argparse.ArgumentParser(description='mkv merge subtitles')
         parser.add_argument('extensions', nargs="*", help='movie file extensions')
         parser.add_argument('-g', '--lang',      metavar='lang',      type=str,  help='languages to keep (default=%s)' % default_languages_to_keep)
+        parser.add_argument('-j', '--jobs',      metavar='jobs',      type=int,  help='number of concurrent ffprobe processes (default=%s)' % default_max_workers)
+        parser.add_argument('-c', '--catalog',   metavar='catalog',   type=str,  help='library catalog file (default=%s)' % default_catalog_file)
         parser.add_argument('-r', '--recursive', dest='recursive',action='store_true', help='recurse in sub folders')
         parser.add_argument('-l', '--log',       dest='log',      action='store_true', help='log to file')
         parser.add_argument('-v', '--verbose',   dest='verbose',  action='store_true', help='verbose mode')
@@ -104,19 +59,14 @@ if __name__ == '__main__':
             fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             logger.addHandler(fileHandler)
 
-        file_list = []
-        for movie_extension in args.extensions:
-            file_pattern = "*.%s"  % movie_extension
-            if args.recursive:
-                file_pattern = "**/%s" % file_pattern
-
-            file_list += glob.glob(file_pattern, recursive=args.recursive)
+        # only the new or modified files are probed, concurrently, and printed in sorted order as soon as possible
+        catalog = LibraryCatalog(args.catalog)
 
-        for filepath in sorted(file_list):
+        for filepath in catalog.scan(args.extensions, args.recursive, jobs=args.jobs or default_max_workers):
 
             # Local file
             print(colored(filepath, "yellow"))
-            stream_list = ffprobe(filepath)
+            stream_list = catalog.get_stream_languages(filepath)
             if stream_list:
                 for (stream_type, language_list) in stream_list.items():
                     language_list_str = ", ".join([colored(l, "cyan") for l in language_list])
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+from functools import lru_cache
+from collections import namedtuple
+
+############################
+# configuration
+############################
+
+default_cache_size = 200000
+default_bench_size = 100000
+
+# separators between the words of a release name
+token_pattern = re.compile(r"[^\s._\-\(\)\[\]\{\}]+")
+
+# tags of a release name, matched against a whole word
+tag_pattern = re.compile(r"""
+    (?P<year>(?:19|20)[0-9]{2})
+    |s(?P<season>[0-9]{1,2})(?:e(?P<episode>[0-9]{1,3}))?
+    |(?P<x_season>[0-9]{1,2})x(?P<x_episode>[0-9]{2,3})
+    |(?P<resolution>[0-9]{3,4}[pi]|4k|uhd)
+    |(?P<source>bluray|bdrip|brrip|bdremux|remux|web|webdl|webrip|hdtv|dvdrip|dvdscr|dvd|hdrip|vhsrip)
+    |(?P<other>x264|x265|h264|h265|hevc|avc|xvid|divx|10bit|hdr|aac|ac3|dts|multi|vff|vfq|vostfr|truefrench|french|proper|repack|extended|unrated|remastered)
+""", re.IGNORECASE | re.VERBOSE)
+
+# release group at the end of a release name (...x264-GROUP)
+group_pattern = re.compile(r"-[^\s._\-]+$")
+
+# "movie" and "the movie" are dropped from the titles
+title_noise_list = [ "movie" ]
+
+video_extensions = set([ "mkv", "mp4", "avi", "m4v", "mov", "wmv", "mpg", "mpeg", "ts", "webm" ])
+
+############################
+# classes
+############################
+
+FilenameInfo = namedtuple("FilenameInfo", [ "title", "year", "season", "episode", "resolution", "source" ])
+
+############################
+# functions
+############################
+
+def strip_extension(filename: str) -> str:
+    filename = os.path.basename(filename)
+    (name, ext) = os.path.splitext(filename)
+    if ext[1:].lower() in video_extensions:
+        return name
+    return filename
+
+@lru_cache(maxsize=default_cache_size)
+def tokenize_filename(filename: str) -> tuple:
+    """lower case words of a file name, extension included"""
+    return tuple(token_pattern.findall(os.path.basename(filename).lower()))
+
+@lru_cache(maxsize=default_cache_size)
+def _parse_basename(basename: str) -> FilenameInfo:
+    stem = strip_extension(basename)
+    word_list = token_pattern.findall(stem)
+    match_list = [ tag_pattern.fullmatch(word) for word in word_list ]
+
+    # words like "french" or "web" are also title words : only season/episode markers and resolutions end the title anywhere
+    strong_index = next((index for (index, m) in enumerate(match_list) if index > 0 and m and (m.group("season") or m.group("x_season") or m.group("resolution"))), len(word_list))
+
+    # the release year is the last one before them, a year at the start is part of the title (2001 A Space Odyssey)
+    year = None
+    title_end = strong_index
+    for index in range(1, strong_index):
+        if match_list[index] and match_list[index].group("year"):
+            year = int(word_list[index])
+            title_end = index
+
+    # without year nor marker, only the trailing tags (and the release group after them) end the title
+    if year == None and title_end == len(word_list):
+        if title_end > 1 and group_pattern.search(stem) and match_list[title_end - 2]:
+            title_end -= 1
+        while title_end > 1 and match_list[title_end - 1] and not match_list[title_end - 1].group("year"):
+            title_end -= 1
+
+    season = None
+    episode = None
+    resolution = None
+    source = None
+    for (index, m) in enumerate(match_list[title_end:], title_end):
+        if not m:
+            continue
+        if m.group("season") and season == None:
+            season = int(m.group("season"))
+            if m.group("episode"):
+                episode = int(m.group("episode"))
+        elif m.group("x_season") and season == None:
+            season = int(m.group("x_season"))
+            episode = int(m.group("x_episode"))
+        elif m.group("resolution") and resolution == None:
+            resolution = word_list[index].lower()
+        elif m.group("source") and source == None:
+            source = word_list[index].lower()
+
+    title_word_list = word_list[:title_end]
+    for (index, word) in reversed(list(enumerate(title_word_list))):
+        if word.lower() in title_noise_list:
+            del title_word_list[index]
+            if index > 0 and title_word_list[index - 1].lower() == "the":
+                del title_word_list[index - 1]
+
+    title = " ".join(title_word_list)
+    if not title:
+        title = stem
+
+    return FilenameInfo(title, year, season, episode, resolution, source)
+
+def parse_filename(filename: str) -> FilenameInfo:
+    """title, year, season, episode, resolution and source of a movie or episode file name"""
+    return _parse_basename(os.path.basename(filename))
+
+def generate_filename_list(size: int, seed: int = 0) -> list:
+    word_list = [ "the", "last", "night", "of", "dark", "star", "love", "war", "city", "king", "lost", "blue", "man", "house", "river", "dead", "moon", "iron", "fight", "club" ]
+    tag_list = [ "1080p", "720p", "2160p", "BluRay", "WEB-DL", "WEBRip", "HDTV", "x264", "x265", "HEVC", "AAC", "DTS", "MULTI", "VFF", "PROPER" ]
+    separator_list = [ ".", " ", "_" ]
+    r = random.Random(seed)
+
+    filename_list = []
+    for i in range(size):
+        separator = r.choice(separator_list)
+        name = [ w.capitalize() for w in r.sample(word_list, r.randint(1, 5)) ]
+        layout = r.randint(0, 3)
+        if layout == 0:
+            name.append("(%d)" % r.randint(1930, 2023))
+        elif layout == 1:
+            name.append(str(r.randint(1930, 2023)))
+            name.extend(r.sample(tag_list, r.randint(1, 4)))
+        elif layout == 2:
+            name.append("S%02dE%02d" % (r.randint(1, 12), r.randint(1, 24)))
+            name.extend(r.sample(tag_list, r.randint(1, 4)))
+        name.append("%d" % i)
+        filename_list.append("%s-GRP.%s" % (separator.join(name), r.choice([ "mkv", "mp4", "avi" ])))
+
+    return filename_list
+
+def bench(size: int):
+    filename_list = generate_filename_list(size)
+
+    _parse_basename.cache_clear()
+    start = time.perf_counter()
+    for filename in filename_list:
+        parse_filename(filename)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for filename in filename_list:
+        parse_filename(filename)
+    warm = time.perf_counter() - start
+
+    print("%d file names" % size)
+    print("first pass : %.3fs (%.1f us/name)" % (cold, cold * 1e6 / size))
+    print("memoized   : %.3fs (%.1f us/name)" % (warm, warm * 1e6 / size))
+    print(_parse_basename.cache_info())
+
+############################
+# main
+############################
+
+if __name__ == '__main__':
+    try:
+
+        # options
+        parser = argparse.ArgumentParser(description='parse movie and episode file names')
+        parser.add_argument('filenames', nargs="*", help='file names to parse')
+        parser.add_argument('-b', '--bench',      metavar='size',      type=int, nargs='?', const=default_bench_size, help='benchmark on generated file names (default=%s)' % default_bench_size)
+
+        args = parser.parse_args()
+
+        if args.bench:
+            bench(args.bench)
+
+        for filename in args.filenames:
+            print("%s: %s" % (filename, parse_filename(filename)))
+
+    # catch keyboard interrupt or broken pipe
+    except (KeyboardInterrupt) as e:
+        print("\ninterrupted")
+        try:
+            sys.stdout.close()
+        except IOError:
+            pass
+        try:
+            sys.stderr.close()
+        except IOError:
+            pass
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+from termcolor import colored
+
+############################
+# configuration
+############################
+
+default_max_jobs = os.cpu_count() or 2
+default_max_jobs_per_device = 1     # jobs reading or writing the same disk at once
+default_ok_returncodes = (0,)
+mkvtoolnix_ok_returncodes = (0, 1)  # mkvmerge and mkvpropedit exit with 1 on warnings, the output is complete
+
+############################
+# classes
+############################
+
+class Job():
+    """a command to run, with its captured output once finished"""
+
+    __slots__ = ("name", "command", "device", "returncode", "output", "duration", "on_success", "ok_returncodes")
+
+    def __init__(self, name: str, command: list, path: str = None, on_success = None, ok_returncodes: tuple = None):
+        self.name = name
+        self.command = command
+        self.on_success = on_success
+        self.ok_returncodes = ok_returncodes if ok_returncodes != None else default_ok_returncodes
+        self.device = None
+        self.returncode = None
+        self.output = ""
+        self.duration = None
+
+        # jobs are limited per device of the file they work on
+        if path != None:
+            try:
+                self.device = os.stat(path).st_dev
+            except OSError:
+                pass
+
+    def succeeded(self) -> bool:
+        return self.returncode in self.ok_returncodes
+
+class JobScheduler():
+    """run commands concurrently, at most max_jobs at once and max_jobs_per_device on the same device
+
+    a failed job doesn't stop the others, the failures are listed in the final summary"""
+
+    def __init__(self, max_jobs: int = None, max_jobs_per_device: int = None):
+        self.max_jobs = max_jobs or default_max_jobs
+        self.max_jobs_per_device = max_jobs_per_device or default_max_jobs_per_device
+        self.job_list = []
+
+    def submit(self, name: str, command: list, path: str = None, on_success = None, ok_returncodes: tuple = None) -> Job:
+        """queue a command, on_success(job) is called from the scheduler thread once it succeeded (with one of ok_returncodes)"""
+        job = Job(name, command, path, on_success, ok_returncodes)
+        self.job_list.append(job)
+        return job
+
+    def run_job(self, job: Job):
+        logging.debug(f"executing command: {job.command}")
+        start = time.monotonic()
+        try:
+            p = subprocess.run(job.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            job.returncode = p.returncode
+            job.output = p.stdout.decode("utf-8", errors="replace")
+        except OSError as e:
+            job.returncode = -1
+            job.output = str(e)
+        job.duration = time.monotonic() - start
+
+    def run(self) -> list:
+        """run all the submitted jobs, print the output of each job when it's finished, return the failed jobs"""
+
+        pending_list = deque(self.job_list)
+        finished_list = deque()
+        running_count = 0
+        device_running_count = {}
+        condition = threading.Condition()
+
+        def run_and_notify(job: Job):
+            try:
+                self.run_job(job)
+            finally:
+                with condition:
+                    finished_list.append(job)
+                    condition.notify()
+
+        failed_list = []
+        with condition:
+            while pending_list or running_count:
+
+                # start the first pending jobs whose device isn't busy
+                for job in list(pending_list):
+                    if running_count >= self.max_jobs:
+                        break
+                    if job.device != None and device_running_count.get(job.device, 0) >= self.max_jobs_per_device:
+                        continue
+                    pending_list.remove(job)
+                    running_count += 1
+                    device_running_count[job.device] = device_running_count.get(job.device, 0) + 1
+                    threading.Thread(target=run_and_notify, args=(job,), daemon=True).start()
+
+                while not finished_list:
+                    condition.wait()
+
+                while finished_list:
+                    job = finished_list.popleft()
+                    running_count -= 1
+                    device_running_count[job.device] -= 1
+                    self.print_job(job)
+                    if not job.succeeded():
+                        failed_list.append(job)
+                    elif job.on_success:
+                        job.on_success(job)
+
+        self.print_summary(failed_list)
+        return failed_list
+
+    def print_job(self, job: Job):
+        if job.returncode == 0:
+            print(colored(f"# done {job.name} ({job.duration:.1f}s)", "green"))
+        elif job.succeeded():
+            print(colored(f"# done with warnings {job.name} ({job.duration:.1f}s, exit code {job.returncode})", "yellow"))
+        else:
+            print(colored(f"# failed {job.name} (exit code {job.returncode})", "red"))
+        if job.output:
+            print(job.output, end="" if job.output.endswith("\n") else "\n")
+        sys.stdout.flush()
+
+    def print_summary(self, failed_list: list):
+        if not self.job_list:
+            return
+        print(colored(f"# {len(self.job_list) - len(failed_list)} jobs done, {len(failed_list)} failed", "red" if failed_list else "green"))
+        for job in failed_list:
+            print(colored(f"failed: {job.name}", "red"))
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import json
+import hashlib
+import sqlite3
+import argparse
+import logging
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+############################
+# configuration
+############################
+
+default_catalog_file = ".library_catalog.sqlite"     # in the library folder, hidden from the scripts globs
+default_movie_extensions = [ "mkv", "mp4", "avi" ]
+default_subtitle_extensions = [ "ass", "srt" ]
+default_max_workers = 8                               # concurrent ffprobe processes
+ffprobe_codec_types = {
+    "audio": "audio",
+    "subtitle": "subtitles",
+    "video": "video"
+}
+ffprobe_stream_entries = "stream=index,codec_type,codec_name,channels:stream_tags=language,title:stream_disposition=default,forced"
+sidecar_language_pattern = re.compile(r"[a-z]{2,3}")
+output_suffix = ".MUX.mkv"                            # files generated by the merge and remove scripts, never used as inputs
+fingerprint_block_size = 65536                        # hashed at the start and the end of each input
+
+############################
+# functions
+############################
+
+def lower_keys(x):
+    if isinstance(x, list):
+        return [lower_keys(v) for v in x]
+    elif isinstance(x, dict):
+        return dict((k.lower(), lower_keys(v)) for k, v in x.items())
+    else:
+        return x
+
+def ffprobe_get_streams(filename: str):
+    """probe the audio, subtitles and video streams of a file with a single ffprobe call"""
+    stream_list = None
+
+    cmd = ["ffprobe", filename, "-show_entries", ffprobe_stream_entries, "-of", "json", "-v", "quiet"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, cwd=os.getcwd())
+
+    try:
+        ret = lower_keys(json.loads(proc.stdout))
+    except ValueError:
+        logging.error("ffprobe failed on %s (exit code %s)" % (filename, proc.returncode))
+        return stream_list
+
+    if "streams" in ret.keys():
+        stream_list = {}
+
+        for stream in ret["streams"]:
+            stream_type = ffprobe_codec_types.get(stream.get("codec_type"))
+            if stream_type == None:
+                continue
+
+            tags = stream.get("tags", {})
+            disposition = stream.get("disposition", {})
+            stream_list.setdefault(stream_type, []).append({
+                "index": stream.get("index"),
+                "codec": stream.get("codec_name"),
+                "channels": stream.get("channels"),
+                "language": tags.get("language"),
+                "title": tags.get("title"),
+                "default": disposition.get("default") == 1,
+                "forced": disposition.get("forced") == 1,
+            })
+
+    return stream_list
+
+def mkvmerge_get_tracks(filename: str):
+    """identify the tracks of a file with mkvmerge -J, from the headers only"""
+
+    proc = subprocess.run(["mkvmerge", "-J", filename], stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+
+    try:
+        ret = json.loads(proc.stdout)
+    except ValueError:
+        ret = {}
+    if proc.returncode == 2 or "tracks" not in ret:
+        logging.error("mkvmerge can't identify %s: %s" % (filename, ", ".join(ret.get("errors", [])) or "exit code %s" % proc.returncode))
+        return None
+
+    track_list = []
+    for track in ret["tracks"]:
+        properties = track.get("properties", {})
+        size = properties.get("tag_number_of_bytes")
+        track_list.append({
+            "id": track["id"],
+            "number": properties.get("number"),
+            "type": track["type"],
+            "codec": track.get("codec"),
+            "language": properties.get("language"),
+            "title": properties.get("track_name"),
+            "default": properties.get("default_track", False),
+            "forced": properties.get("forced_track", False),
+            "size": int(size) if size != None else None,
+        })
+
+    return track_list
+
+def walk_library(extensions: list, recursive: bool = False, subtitle_extensions: list = None):
+    """list the movie files like glob("[**/]*.ext") and their sidecar subtitles (movie.lang.ext) in a single walk
+
+    return the sorted movie paths and a {movie path: {lang: subtitle path}} dict"""
+
+    if subtitle_extensions == None:
+        subtitle_extensions = default_subtitle_extensions
+
+    file_list = []
+    sidecar_list = {}
+
+    directory_list = [ "" ]
+    while directory_list:
+        directory = directory_list.pop()
+        try:
+            entry_list = list(os.scandir(directory or "."))
+        except OSError as e:
+            logging.error("can't list %s: %s" % (directory or ".", e))
+            continue
+
+        subtitle_list = {}
+        for entry in entry_list:
+            # like glob, hidden files are ignored
+            if entry.name.startswith("."):
+                continue
+            path = os.path.join(directory, entry.name)
+
+            if entry.is_dir():
+                if recursive:
+                    directory_list.append(path)
+                continue
+
+            # generated files are outputs only
+            if entry.name.endswith(output_suffix):
+                continue
+
+            (name, extension) = os.path.splitext(entry.name)
+            extension = extension[1:]
+            if extension in extensions:
+                file_list.append(path)
+            if extension in subtitle_extensions:
+                (base, _, lang) = name.rpartition(".")
+                if base and sidecar_language_pattern.fullmatch(lang):
+                    subtitle_list.setdefault(os.path.join(directory, base), []).append((subtitle_extensions.index(extension), lang, path))
+
+        for (base, subtitle_extension_list) in subtitle_list.items():
+            # same language in several formats : the last extension of the list wins
+            sidecar_list[base] = dict((lang, path) for (_, lang, path) in sorted(subtitle_extension_list))
+
+    file_list.sort()
+    return (file_list, dict((filepath, sidecar_list.get(os.path.splitext(filepath)[0], {})) for filepath in file_list))
+
+def get_output_path(filepath: str) -> str:
+    return os.path.splitext(filepath)[0] + output_suffix
+
+def get_file_fingerprint(filepath: str) -> list:
+    """size, mtime and hash of the first and last blocks of a file, cheap even for multi-GB movies"""
+    st = os.stat(filepath)
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        h.update(f.read(fingerprint_block_size))
+        if st.st_size > fingerprint_block_size:
+            f.seek(max(fingerprint_block_size, st.st_size - fingerprint_block_size))
+            h.update(f.read(fingerprint_block_size))
+    return [ filepath, st.st_size, st.st_mtime_ns, h.hexdigest() ]
+
+def get_inputs_fingerprint(input_list: list, command: list) -> str:
+    """fingerprint of the inputs of an output file and of the command generating it"""
+    fingerprint_list = [ get_file_fingerprint(filepath) for filepath in input_list ]
+    return hashlib.sha1(json.dumps([ fingerprint_list, command ]).encode("utf-8")).hexdigest()
+
+############################
+# classes
+############################
+
+class LibraryCatalog():
+    """SQLite catalog of the movie files of a library: size, mtime, streams and sidecar subtitles
+
+    entries are refreshed only for the files whose size or mtime changed"""
+
+    def __init__(self, filename: str = None):
+        if filename == None:
+            filename = default_catalog_file
+        self.db = sqlite3.connect(filename)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS file (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, probed INTEGER, scanned REAL);
+            CREATE TABLE IF NOT EXISTS stream (path TEXT, stream_index INTEGER, type TEXT, codec TEXT, channels INTEGER, language TEXT, title TEXT, is_default INTEGER, is_forced INTEGER);
+            CREATE TABLE IF NOT EXISTS sidecar (path TEXT, language TEXT, subtitle_path TEXT, size INTEGER, mtime REAL);
+            CREATE TABLE IF NOT EXISTS output (path TEXT PRIMARY KEY, fingerprint TEXT, built REAL);
+            CREATE INDEX IF NOT EXISTS stream_index ON stream (path);
+            CREATE INDEX IF NOT EXISTS sidecar_index ON sidecar (path);
+            CREATE INDEX IF NOT EXISTS sidecar_language_index ON sidecar (language);
+        """)
+        self.db.commit()
+
+    def scan(self, extensions: list = None, recursive: bool = False, probe: bool = True, jobs: int = None, subtitle_extensions: list = None):
+        """walk the library and refresh the changed entries, probing their streams concurrently if asked
+
+        yield each movie path in sorted order as soon as its entry is up to date"""
+
+        if extensions == None:
+            extensions = default_movie_extensions
+
+        (file_list, sidecar_list) = walk_library(extensions, recursive, subtitle_extensions)
+        scanned = datetime.now().timestamp()
+
+        changed_list = set()
+        probe_list = set()
+        stat_list = {}
+        for filepath in file_list:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            stat_list[filepath] = st
+            row = self.db.execute("SELECT size, mtime, probed FROM file WHERE path = ?", (filepath,)).fetchone()
+            if row == None or row[0] != st.st_size or row[1] != st.st_mtime:
+                changed_list.add(filepath)
+                if probe:
+                    probe_list.add(filepath)
+            elif probe and not row[2]:
+                probe_list.add(filepath)
+
+        logging.debug("[catalog] %s files, %s changed, %s to probe" % (len(file_list), len(changed_list), len(probe_list)))
+
+        def probe_file(filepath: str):
+            if filepath in probe_list:
+                return ffprobe_get_streams(filepath)
+            return None
+
+        with ThreadPoolExecutor(max_workers=jobs or default_max_workers) as executor:
+            for (filepath, stream_list) in zip(file_list, executor.map(probe_file, file_list)):
+                if filepath not in stat_list:
+                    continue
+                st = stat_list[filepath]
+
+                if filepath in changed_list or filepath in probe_list:
+                    probed = filepath in probe_list and stream_list != None
+                    self.db.execute("INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?, ?)", (filepath, st.st_size, st.st_mtime, probed, scanned))
+                    self.db.execute("DELETE FROM stream WHERE path = ?", (filepath,))
+                    for (stream_type, substream_list) in (stream_list or {}).items():
+                        for stream in substream_list:
+                            self.db.execute("INSERT INTO stream VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (filepath, stream["index"], stream_type, stream["codec"], stream["channels"], stream["language"], stream["title"], stream["default"], stream["forced"]))
+                else:
+                    self.db.execute("UPDATE file SET scanned = ? WHERE path = ?", (scanned, filepath))
+
+                # sidecars don't change the movie mtime, they are listed again on each scan
+                self.db.execute("DELETE FROM sidecar WHERE path = ?", (filepath,))
+                for (lang, subtitle_filepath) in sidecar_list[filepath].items():
+                    subtitle_st = os.stat(subtitle_filepath)
+                    self.db.execute("INSERT INTO sidecar VALUES (?, ?, ?, ?, ?)", (filepath, lang, subtitle_filepath, subtitle_st.st_size, subtitle_st.st_mtime))
+
+                self.db.commit()
+                yield filepath
+
+        # files of the scanned folders which don't exist anymore
+        for (filepath,) in self.db.execute("SELECT path FROM file WHERE scanned < ?", (scanned,)).fetchall():
+            if recursive or os.path.dirname(filepath) == "":
+                if filepath.endswith(output_suffix) or (os.path.splitext(filepath)[1][1:] in extensions and not os.path.exists(filepath)):
+                    logging.debug("[catalog] %s removed" % filepath)
+                    self.delete(filepath)
+        self.db.commit()
+
+    def delete(self, filepath: str):
+        self.db.execute("DELETE FROM file WHERE path = ?", (filepath,))
+        self.db.execute("DELETE FROM stream WHERE path = ?", (filepath,))
+        self.db.execute("DELETE FROM sidecar WHERE path = ?", (filepath,))
+
+    def is_up_to_date(self, output_filepath: str, fingerprint: str) -> bool:
+        """True if the output exists and was generated from the same inputs, like make"""
+        if not os.path.exists(output_filepath):
+            return False
+        row = self.db.execute("SELECT fingerprint FROM output WHERE path = ?", (output_filepath,)).fetchone()
+        return row != None and row[0] == fingerprint
+
+    def set_output(self, output_filepath: str, fingerprint: str):
+        self.db.execute("INSERT OR REPLACE INTO output VALUES (?, ?, ?)", (output_filepath, fingerprint, datetime.now().timestamp()))
+        self.db.commit()
+
+    def get_streams(self, filepath: str, stream_type: str = None) -> list:
+        query = "SELECT stream_index, type, codec, channels, language, title, is_default, is_forced FROM stream WHERE path = ?"
+        params = [ filepath ]
+        if stream_type != None:
+            query += " AND type = ?"
+            params.append(stream_type)
+
+        stream_list = []
+        for (index, type, codec, channels, language, title, is_default, is_forced) in self.db.execute(query + " ORDER BY stream_index", params):
+            stream_list.append({
+                "index": index,
+                "type": type,
+                "codec": codec,
+                "channels": channels,
+                "language": language,
+                "title": title,
+                "default": bool(is_default),
+                "forced": bool(is_forced),
+            })
+        return stream_list
+
+    def get_stream_languages(self, filepath: str) -> dict:
+        """{stream type: [languages]} of the audio and subtitles streams with a language"""
+        stream_language_list = {}
+        for stream_type in ["audio", "subtitles"]:
+            language_list = [ stream["language"] for stream in self.get_streams(filepath, stream_type) if stream["language"] ]
+            if language_list:
+                stream_language_list[stream_type] = language_list
+        return stream_language_list
+
+    def get_sidecars(self, filepath: str) -> dict:
+        """{lang: subtitle path} of the sidecar subtitles of a movie"""
+        return dict(self.db.execute("SELECT language, subtitle_path FROM sidecar WHERE path = ? ORDER BY language", (filepath,)).fetchall())
+
+    def get_files(self) -> list:
+        return [ filepath for (filepath,) in self.db.execute("SELECT path FROM file ORDER BY path") ]
+
+    def get_files_with_untagged_streams(self, stream_type: str = "audio") -> list:
+        return [ filepath for (filepath,) in self.db.execute("SELECT DISTINCT path FROM stream WHERE type = ? AND (language IS NULL OR language = 'und') ORDER BY path", (stream_type,)) ]
+
+    def get_files_with_sidecar(self, language: str = None, extension: str = None) -> list:
+        query = "SELECT DISTINCT path FROM sidecar WHERE 1"
+        params = []
+        if language != None:
+            query += " AND language = ?"
+            params.append(language)
+        if extension != None:
+            query += " AND subtitle_path LIKE ?"
+            params.append("%." + extension)
+        return [ filepath for (filepath,) in self.db.execute(query + " ORDER BY path", params) ]
+
+    def get_files_without_language(self, stream_type: str, language: str) -> list:
+        return [ filepath for (filepath,) in self.db.execute("SELECT path FROM file WHERE probed AND path NOT IN (SELECT path FROM stream WHERE type = ? AND language = ?) ORDER BY path", (stream_type, language)) ]
+
+############################
+# main
+############################
+if __name__ == '__main__':
+    try:
+
+        script_name = os.path.basename(__file__)
+
+        # options
+        parser = argparse.ArgumentParser(description='movie library catalog : streams and sidecar subtitles')
+        parser.add_argument('extensions', nargs="*", help='movie file extensions (default=%s)' % str(default_movie_extensions))
+        parser.add_argument('-c', '--catalog',   metavar='catalog',   type=str,  help='catalog file (default=%s)' % default_catalog_file)
+        parser.add_argument('-j', '--jobs',      metavar='jobs',      type=int,  help='number of concurrent ffprobe processes (default=%s)' % default_max_workers)
+        parser.add_argument('-n', '--no-update', dest='no_update', action='store_true', help='query the catalog without scanning the library')
+        parser.add_argument('-u', '--untagged',  metavar='type',      type=str,  help='list files with untagged streams : audio, subtitles')
+        parser.add_argument('-s', '--sidecar',   metavar='lang',      type=str,  help='list files with a sidecar subtitle in this language')
+        parser.add_argument('-m', '--missing',   metavar='lang',      type=str,  help='list files without audio in this language')
+        parser.add_argument('-r', '--recursive', dest='recursive',action='store_true', help='recurse in sub folders')
+        parser.add_argument('-l', '--log',       dest='log',      action='store_true', help='log to file')
+        parser.add_argument('-v', '--verbose',   dest='verbose',  action='store_true', help='verbose mode')
+
+        args = parser.parse_args()
+        if len(args.extensions) == 0:
+            args.extensions = default_movie_extensions
+
+        # logger
+        if args.verbose:
+            logLevel = logging.DEBUG
+        else:
+            logLevel = logging.INFO
+        logging.basicConfig(stream=sys.stdout, level=logLevel, format='%(asctime)s - %(levelname)s - %(message)s')
+        logger = logging.getLogger()
+
+        if args.log:
+            logFile = "%s_%s.log" % (script_name, datetime.now().strftime('%Y%m%d_%H%M%S'))
+            fileHandler = logging.FileHandler(logFile)
+            fileHandler.setLevel(logging.INFO)
+            fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            logger.addHandler(fileHandler)
+
+        catalog = LibraryCatalog(args.catalog)
+
+        if not args.no_update:
+            file_count = 0
+            for filepath in catalog.scan(args.extensions, args.recursive, jobs=args.jobs):
+                file_count += 1
+            logging.info("catalog updated : %s files" % file_count)
+
+        query_list = []
+        if args.untagged:
+            query_list.append(catalog.get_files_with_untagged_streams(args.untagged))
+        if args.sidecar:
+            query_list.append(catalog.get_files_with_sidecar(args.sidecar))
+        if args.missing:
+            query_list.append(catalog.get_files_without_language("audio", args.missing))
+
+        if query_list:
+            # several queries : files matching all of them
+            result_list = set(query_list[0]).intersection(*query_list[1:])
+            for filepath in sorted(result_list):
+                print(filepath)
+
+    # catch keyboard interrupt or broken pipe
+    except (KeyboardInterrupt) as e:
+        print("\ninterrupted")
+        try:
+            sys.stdout.close()
+        except IOError:
+            pass
+        try:
+            sys.stderr.close()
+        except IOError:
+            pass
@@ -1,14 +1,13 @@
 #!/usr/bin/env python
 import os
-import re
 import sys
-import glob
 import argparse
 # import configparser
 import logging
 from datetime import datetime
-import subprocess
 from termcolor import colored
+from library_catalog import LibraryCatalog, default_catalog_file, get_output_path, get_inputs_fingerprint
+from job_scheduler import JobScheduler, default_max_jobs, default_max_jobs_per_device, mkvtoolnix_ok_returncodes
 
 ############################
 # configuration
@@ -34,6 +33,10 @@ if __name__ == '__main__':
         # options
         parser = argparse.ArgumentParser(description='mkv merge subtitles')
         parser.add_argument('extensions', nargs="*", help='movie file extensions')
+        parser.add_argument('-j', '--jobs',      metavar='jobs',      type=int,  help='number of concurrent mkvmerge jobs (default=%s)' % default_max_jobs)
+        parser.add_argument('-d', '--device-jobs', metavar='jobs',    type=int,  help='number of concurrent mkvmerge jobs on the same disk (default=%s)' % default_max_jobs_per_device)
+        parser.add_argument('-c', '--catalog',   metavar='catalog',   type=str,  help='library catalog file (default=%s)' % default_catalog_file)
+        parser.add_argument('-f', '--force',     dest='force',    action='store_true', help='generate the outputs even if they are up to date')
         parser.add_argument('-r', '--recursive', dest='recursive',action='store_true', help='recurse in sub folders')
         parser.add_argument('-l', '--log',       dest='log',      action='store_true', help='log to file')
         parser.add_argument('-v', '--verbose',   dest='verbose',  action='store_true', help='verbose mode')
@@ -57,43 +60,40 @@ if __name__ == '__main__':
             fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             logger.addHandler(fileHandler)
 
-        file_list = []
-        for movie_extension in args.extensions:
-            file_pattern = "*.%s"  % movie_extension
-            if args.recursive:
-                file_pattern = "**/%s" % file_pattern
+        # the movie files and their sidecar subtitles are listed in a single walk, without reading the media
+        catalog = LibraryCatalog(args.catalog)
+        scheduler = JobScheduler(max_jobs=args.jobs, max_jobs_per_device=args.device_jobs)
 
-            file_list += glob.glob(file_pattern, recursive=args.recursive)
-
-        for filepath in sorted(file_list):
+        for filepath in catalog.scan(args.extensions, args.recursive, probe=False, subtitle_extensions=default_subtitle_extensions):
             logging.debug("%s" % filepath)
             filepath_without_ext = os.path.splitext(filepath)[0]
 
-            subtitle_list = {}
-
-            for subtitle_extension in default_subtitle_extensions:
-                subtitle_file_pattern = "%s.*.%s" % (glob.escape(filepath_without_ext), subtitle_extension)
-                for subtitle_filepath in glob.glob(subtitle_file_pattern):
-                    logging.debug("found file: %s" % subtitle_filepath)
-                    m = re.match(r"%s.([a-z]{2,3}).%s" % (re.escape(filepath_without_ext), subtitle_extension), subtitle_filepath)
-                    if (m):
-                        lang = m.group(1)
-                        logging.debug("subtitle found : %s (lang=%s)" % (subtitle_filepath, lang))
-                        subtitle_list[lang] = subtitle_filepath
+            subtitle_list = catalog.get_sidecars(filepath)
+            for (lang, subtitle_filepath) in subtitle_list.items():
+                logging.debug("subtitle found : %s (lang=%s)" % (subtitle_filepath, lang))
 
             if len(subtitle_list) > 0:
                 print(colored(f"# found {filepath}", "yellow"))
 
-                output_file = filepath_without_ext + ".mux.mkv"
+                output_file = get_output_path(filepath)
 
-                command = [ "mkvmerge", "-o", f"{filepath_without_ext}.MUX.mkv", filepath ]
+                command = [ "mkvmerge", "-o", output_file, filepath ]
                 for (lang, subtitle_filepath) in subtitle_list.items():
                     command += [ "--language", f"0:{lang}", subtitle_filepath ]
                     print(f"found subtitle {subtitle_filepath} (lang: {lang})")
 
+                # like make, skip the outputs generated from the same movie, subtitles and options
+                fingerprint = get_inputs_fingerprint([ filepath ] + list(subtitle_list.values()), command)
+                if not args.force and catalog.is_up_to_date(output_file, fingerprint):
+                    print(f"{output_file} is up to date")
+                    continue
+
                 print(f"generating {output_file}")
-                logging.debug(f"executing command: {command}")
-                p = subprocess.run(command, check=True, stdout=sys.stdout, stderr=sys.stderr)
+                scheduler.submit(output_file, command, path=filepath, ok_returncodes=mkvtoolnix_ok_returncodes, on_success=lambda job, output_file=output_file, fingerprint=fingerprint: catalog.set_output(output_file, fingerprint))
+
+        # run the remuxes concurrently, one per disk by default, and go on after a failure
+        if scheduler.run():
+            sys.exit(1)
         
     # catch keyboard interrupt or broken pipe
     except (KeyboardInterrupt) as e:
@@ -2,13 +2,14 @@
 import os
 import re
 import sys
-import glob
 import argparse
 # import configparser
 import logging
 from datetime import datetime
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import colored
+from library_catalog import LibraryCatalog, default_catalog_file, get_output_path, get_inputs_fingerprint, mkvmerge_get_tracks
+from job_scheduler import JobScheduler, default_max_jobs, default_max_jobs_per_device, mkvtoolnix_ok_returncodes
 
 ############################
 # configuration
@@ -23,6 +24,50 @@ default_languages_to_keep = [ "eng", "fre" ]
 # functions
 ############################
 
+def get_unused_tracks(track_list: list, language_list: list) -> list:
+    """audio and subtitles tracks which the remux would drop"""
+    return [ track for track in track_list if track["type"] in ("audio", "subtitles") and track["language"] not in language_list ]
+
+def get_default_flag_edits(track_list: list, default_language_list: dict) -> list:
+    """(track, flag) default flags to change so that the first track of each type in the wanted language is the default one"""
+    edit_list = []
+    for (track_type, language) in default_language_list.items():
+        if language == None:
+            continue
+        type_track_list = [ track for track in track_list if track["type"] == track_type ]
+        default_track = next((track for track in type_track_list if track["language"] == language), None)
+        if default_track == None:
+            logging.debug("no %s track in %s, default flags unchanged" % (track_type, language))
+            continue
+        for track in type_track_list:
+            if track["default"] != (track is default_track):
+                edit_list.append((track, track is default_track))
+    return edit_list
+
+def get_remux_flag_options(edit_list: list) -> list:
+    options = []
+    for (track, flag) in edit_list:
+        options += [ "--default-track-flag", "%s:%d" % (track["id"], flag) ]
+    return options
+
+def get_header_edit_command(filepath: str, edit_list: list) -> list:
+    """mkvpropedit command changing the track headers in place, without rewriting the file"""
+    command = [ "mkvpropedit", filepath ]
+    for (track, flag) in edit_list:
+        # track numbers as stored in the headers, or the position of the track
+        selector = "track:@%s" % track["number"] if track["number"] != None else "track:%s" % (track["id"] + 1)
+        command += [ "--edit", selector, "--set", "flag-default=%d" % flag ]
+    return command
+
+def format_size(size: int) -> str:
+    if size == None:
+        return "unknown size"
+    for unit in [ "B", "KB", "MB", "GB" ]:
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return "%.1f %s" % (size, unit) if unit != "B" else "%d B" % size
+
 ############################
 # main
 ############################
@@ -34,7 +79,14 @@ if __name__ == '__main__':
         # options
         parser = argparse.ArgumentParser(description='mkv merge subtitles')
         parser.add_argument('extensions', nargs="*", help='movie file extensions')
-        parser.add_argument('-g', '--lang',      metavar='lang',      type=str,  help='languages to keep (default=%s)' % default_languages_to_keep)
+        parser.add_argument('-g', '--lang',      metavar='lang',      type=str,  help='comma separated languages to keep (default=%s)' % ",".join(default_languages_to_keep))
+        parser.add_argument('-a', '--default-audio', metavar='lang',  type=str,  help='make the first audio track in this language the default one')
+        parser.add_argument('-s', '--default-subtitles', metavar='lang', type=str, help='make the first subtitles track in this language the default one')
+        parser.add_argument('-j', '--jobs',      metavar='jobs',      type=int,  help='number of concurrent mkvmerge jobs (default=%s)' % default_max_jobs)
+        parser.add_argument('-d', '--device-jobs', metavar='jobs',    type=int,  help='number of concurrent mkvmerge jobs on the same disk (default=%s)' % default_max_jobs_per_device)
+        parser.add_argument('-c', '--catalog',   metavar='catalog',   type=str,  help='library catalog file (default=%s)' % default_catalog_file)
+        parser.add_argument('-f', '--force',     dest='force',    action='store_true', help='generate the outputs even if they are up to date')
+        parser.add_argument('-n', '--dry-run',   dest='dry_run',  action='store_true', help='list the tracks to remove and the size saved, without remuxing')
         parser.add_argument('-r', '--recursive', dest='recursive',action='store_true', help='recurse in sub folders')
         parser.add_argument('-l', '--log',       dest='log',      action='store_true', help='log to file')
         parser.add_argument('-v', '--verbose',   dest='verbose',  action='store_true', help='verbose mode')
@@ -43,8 +95,10 @@ if __name__ == '__main__':
         if len(args.extensions) == 0:
             args.extensions = default_movie_extensions
 
-        if len(args.lang) == 0:
+        if args.lang == None:
             args.lang = default_languages_to_keep
+        else:
+            args.lang = [ lang for lang in args.lang.split(",") if lang ]
 
         # logger
         if args.verbose:
@@ -61,27 +115,75 @@ if __name__ == '__main__':
             fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             logger.addHandler(fileHandler)
 
-        file_list = []
-        for movie_extension in args.extensions:
-            file_pattern = "*.%s"  % movie_extension
-            if args.recursive:
-                file_pattern = "**/%s" % file_pattern
+        catalog = LibraryCatalog(args.catalog)
+        scheduler = JobScheduler(max_jobs=args.jobs, max_jobs_per_device=args.device_jobs)
 
-            file_list += glob.glob(file_pattern, recursive=args.recursive)
+        languages_list = ",".join(args.lang)
+        default_language_list = { "audio": args.default_audio, "subtitles": args.default_subtitles }
+        remux_list = []
 
-        for filepath in sorted(file_list):
+        for filepath in catalog.scan(args.extensions, args.recursive, probe=False):
             logging.debug("%s" % filepath)
-            filepath_without_ext = os.path.splitext(filepath)[0]
-
-            print(colored(f"# found {filepath}", "yellow"))
-
-            output_file = filepath_without_ext + ".mux.mkv"
-            languages_list = ",".join(args.lang)
 
-            command = [ "mkvmerge", "-o", f"{filepath_without_ext}.MUX.mkv", "--audio-tracks", languages_list, "--subtitle-tracks", languages_list, filepath ]
-            print(f"generating {output_file}")
-            logging.debug(f"executing command: {command}")
-            p = subprocess.run(command, check=True, stdout=sys.stdout, stderr=sys.stderr)
+            output_file = get_output_path(filepath)
+            command = [ "mkvmerge", "-o", output_file, "--audio-tracks", languages_list, "--subtitle-tracks", languages_list, filepath ]
+
+            # like make, skip the outputs generated from the same movie and options
+            fingerprint = get_inputs_fingerprint([ filepath ], command + [ "default:%s" % default_language for default_language in default_language_list.values() ])
+            if not args.force and catalog.is_up_to_date(output_file, fingerprint):
+                print(colored(f"# found {filepath}", "yellow"))
+                print(f"{output_file} is up to date")
+                continue
+
+            remux_list.append((filepath, output_file, command, fingerprint))
+
+        # identify the tracks first, a remux rewrites the whole file and is only worth it if some tracks are dropped
+        saved_size = 0
+        unknown_size_count = 0
+        with ThreadPoolExecutor(max_workers=args.jobs or default_max_jobs) as executor:
+            track_list_iterator = executor.map(mkvmerge_get_tracks, [ filepath for (filepath, output_file, command, fingerprint) in remux_list ])
+
+            for ((filepath, output_file, command, fingerprint), track_list) in zip(remux_list, track_list_iterator):
+                print(colored(f"# found {filepath}", "yellow"))
+                if track_list == None:
+                    continue
+
+                unused_track_list = get_unused_tracks(track_list, args.lang)
+                edit_list = get_default_flag_edits([ track for track in track_list if track not in unused_track_list ], default_language_list)
+
+                for track in unused_track_list:
+                    print(f"removing {track['type']} track {track['id']} (lang: {track['language']}, {format_size(track['size'])})")
+                    if track["size"] != None:
+                        saved_size += track["size"]
+                    else:
+                        unknown_size_count += 1
+
+                for (track, flag) in edit_list:
+                    print(f"{'setting' if flag else 'clearing'} default flag of {track['type']} track {track['id']} (lang: {track['language']})")
+
+                if len(unused_track_list) == 0 and len(edit_list) == 0:
+                    print("no track to remove")
+                    continue
+
+                if args.dry_run:
+                    continue
+
+                # only the headers change : edit them in place instead of writing a copy of the whole movie
+                if len(unused_track_list) == 0 and filepath.endswith(".mkv"):
+                    print(f"editing {filepath}")
+                    scheduler.submit(filepath, get_header_edit_command(filepath, edit_list), path=filepath, ok_returncodes=mkvtoolnix_ok_returncodes)
+                    continue
+
+                command = command[:-1] + get_remux_flag_options(edit_list) + command[-1:]
+                print(f"generating {output_file}")
+                scheduler.submit(output_file, command, path=filepath, ok_returncodes=mkvtoolnix_ok_returncodes, on_success=lambda job, output_file=output_file, fingerprint=fingerprint: catalog.set_output(output_file, fingerprint))
+
+        if args.dry_run:
+            print(colored(f"# {format_size(saved_size)} to save" + (f" (+ {unknown_size_count} track{'s' if unknown_size_count > 1 else ''} of unknown size)" if unknown_size_count else ""), "green"))
+
+        # run the remuxes concurrently, one per disk by default, and go on after a failure
+        if scheduler.run():
+            sys.exit(1)
         
     # catch keyboard interrupt or broken pipe
     except (KeyboardInterrupt) as e:
@@ -1,17 +1,28 @@
 #!/usr/bin/env python
 
 import os
-import re
 import sys
 import glob
+import time
+import sqlite3
 import argparse
 import logging
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urlparse
+from datetime import datetime, timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import csv
 import json
-from fuzzywuzzy import fuzz
+import ast
+import hashlib
+from rapidfuzz import fuzz, process, utils
 from termcolor import colored
 from tqdm import tqdm
+from filename_parser import parse_filename
 
 ############################
 # configuration
@@ -24,6 +35,18 @@ default_min_fuzz_ratio = 70
 default_content_type_list = ["movie"]
 default_monetization_type_list = ["flatrate", "free"]
 default_provider_list = ["nfx", "prv", "dnp"]
+default_max_workers = 8
+default_max_requests_per_second = 10
+default_max_retries = 5
+default_retry_backoff_factor = 0.5      # 0.5s, 1s, 2s, 4s... between retries, unless the server sends Retry-After
+default_cache_file = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "search_providers.sqlite")
+default_cache_ttl = 7 * 86400           # results with offers from the providers
+default_cache_ttl_no_offer = 86400      # results without any offer may get one soon
+default_cache_size = 20000
+default_catalog_file = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "search_providers_catalog.sqlite")
+default_catalog_page_size = 100
+default_catalog_max_candidates = 50
+default_output_formats = [ "text", "json", "ndjson", "csv" ]
 provider_names = {
     "nfx": "Netflix",
     "prv": "Amazon Prime Video",
@@ -40,11 +63,9 @@ provider_names = {
 ############################
 
 class Content():
-    title = None
-    type = None
-    release_year = None
-    ratio = None
-    provider_list = []
+    """a matched title, slotted to keep memory flat on big libraries"""
+
+    __slots__ = ("title", "type", "release_year", "ratio", "provider_list")
 
     def __init__(self, 
         title: str,
@@ -56,82 +77,365 @@ class Content():
         self.title = title
         self.type = type
         self.ratio = ratio
-        if release_year != None:
-            self.release_year = release_year 
-        if provider_list != None:
-            self.provider_list = provider_list
+        self.release_year = release_year
+        self.provider_list = provider_list if provider_list != None else []
+
+    def to_dict(self) -> dict:
+        return {
+            "title": self.title,
+            "type": self.type,
+            "release_year": self.release_year,
+            "ratio": self.ratio,
+            "providers": [ provider_names.get(p, p) for p in self.provider_list ],
+        }
 
     def __str__(self) -> str:
         providers = [ provider_names[p] for p in self.provider_list]
         return "%s (%s) [%s] [ratio: %s] -> %s" % (self.title, self.release_year, self.type, self.ratio, ", ".join(providers))
 
+class HostRateLimiter():
+    """limit the number of requests per second sent to each host, shared by all threads"""
+
+    def __init__(self, max_requests_per_second: float):
+        self.interval = 1.0 / max_requests_per_second if max_requests_per_second else 0
+        self.next_request_time = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time.get(host, now))
+            self.next_request_time[host] = request_time + self.interval
+
+        if request_time > now:
+            time.sleep(request_time - now)
+
+rate_limiter = HostRateLimiter(default_max_requests_per_second)
+
+class SearchCache():
+    """persistent cache of the search results (raw items), with offer aware expiry and LRU eviction"""
+
+    def __init__(self, filename: str, ttl: int = None, ttl_no_offer: int = None, size: int = None, refresh: bool = False):
+        self.ttl = ttl if ttl != None else default_cache_ttl
+        self.ttl_no_offer = ttl_no_offer if ttl_no_offer != None else default_cache_ttl_no_offer
+        self.size = size if size != None else default_cache_size
+        self.refresh = refresh
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS search (key TEXT PRIMARY KEY, expires REAL, accessed REAL, items TEXT)")
+        self.db.commit()
+
+    @staticmethod
+    def get_key(query: str, language: str, content_type_list: list, provider_list: list, monetization_type_list: list) -> str:
+        return json.dumps([query, language, sorted(content_type_list), sorted(provider_list), sorted(monetization_type_list)])
+
+    def get_expiry(self, search_result_list: list) -> float:
+        now = time.time()
+        expires = now + self.ttl_no_offer
+        for search_result in search_result_list:
+            for offer in search_result.get("offers", []):
+                if offer["monetization_type"] in default_monetization_type_list and offer["package_short_name"] in default_provider_list:
+                    expires = now + self.ttl
+
+        # offers leaving a provider
+        for search_result in search_result_list:
+            for offer in search_result.get("offers", []):
+                if offer.get("available_to"):
+                    try:
+                        available_to = datetime.fromisoformat(offer["available_to"].replace("Z", "+00:00"))
+                        if available_to.tzinfo == None:
+                            available_to = available_to.replace(tzinfo=timezone.utc)
+                        expires = max(now, min(expires, available_to.timestamp()))
+                    except ValueError:
+                        pass
+
+        return expires
+
+    def get(self, key: str) -> list:
+        if self.refresh:
+            return None
+
+        with self.lock:
+            row = self.db.execute("SELECT expires, items FROM search WHERE key = ?", (key,)).fetchone()
+            if row == None or row[0] < time.time():
+                return None
+            self.db.execute("UPDATE search SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+
+        logging.debug("[cache] %s" % key)
+        return json.loads(row[1])
+
+    def set(self, key: str, search_result_list: list):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO search VALUES (?, ?, ?, ?)", (key, self.get_expiry(search_result_list), time.time(), json.dumps(search_result_list)))
+            self.db.execute("DELETE FROM search WHERE key IN (SELECT key FROM search ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.size,))
+            self.db.commit()
+
+search_cache = None
+
+class ProviderCatalog():
+    """local index of the popular catalog of the providers: titles, title trigrams and offers"""
+
+    def __init__(self, filename: str):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        page_title_exists = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'page_title'").fetchone() != None
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS page (page INTEGER PRIMARY KEY, hash TEXT, synced REAL);
+            CREATE TABLE IF NOT EXISTS title (id INTEGER PRIMARY KEY, title TEXT, original_release_year INTEGER, object_type TEXT, names TEXT);
+            CREATE TABLE IF NOT EXISTS page_title (page INTEGER, title_id INTEGER, PRIMARY KEY (page, title_id));
+            CREATE TABLE IF NOT EXISTS trigram (trigram TEXT, title_id INTEGER);
+            CREATE TABLE IF NOT EXISTS offer (title_id INTEGER, monetization_type TEXT, package_short_name TEXT);
+            CREATE INDEX IF NOT EXISTS trigram_index ON trigram (trigram);
+            CREATE INDEX IF NOT EXISTS offer_index ON offer (title_id);
+            CREATE INDEX IF NOT EXISTS page_title_index ON page_title (title_id);
+        """)
+
+        # catalogs synced before page_title kept the page of each title in the title table
+        if not page_title_exists and "page" in [ column[1] for column in self.db.execute("PRAGMA table_info(title)") ]:
+            self.db.execute("INSERT OR IGNORE INTO page_title SELECT page, id FROM title WHERE page IS NOT NULL")
+        self.db.commit()
+
+    @staticmethod
+    def get_trigrams(text: str) -> set:
+        text = "  %s " % utils.default_process(text)
+        return set(text[i:i+3] for i in range(len(text) - 2))
+
+    def update_page(self, page: int, search_result_list: list) -> bool:
+        """replace the titles of a page, unless the page did not change since the last sync"""
+        page_hash = hashlib.sha1(json.dumps(search_result_list, sort_keys=True).encode("utf-8")).hexdigest()
+        row = self.db.execute("SELECT hash FROM page WHERE page = ?", (page,)).fetchone()
+        if row != None and row[0] == page_hash:
+            logging.debug("[catalog] page %s unchanged" % page)
+            return False
+
+        logging.debug("[catalog] page %s updated" % page)
+        previous_title_id_list = [ title_id for (title_id,) in self.db.execute("SELECT title_id FROM page_title WHERE page = ?", (page,)) ]
+        self.db.execute("DELETE FROM page_title WHERE page = ?", (page,))
+
+        # a title can be listed by several pages while the ranks shift, its data is replaced by the latest one
+        for search_result in search_result_list:
+            self.delete_title(search_result["id"])
+            names = get_search_result_titles(search_result)
+            self.db.execute("INSERT INTO title (id, title, original_release_year, object_type, names) VALUES (?, ?, ?, ?, ?)", (search_result["id"], search_result["title"], search_result.get("original_release_year"), search_result["object_type"], json.dumps(names)))
+            self.db.execute("INSERT OR IGNORE INTO page_title VALUES (?, ?)", (page, search_result["id"]))
+            trigrams = set()
+            for name in names:
+                trigrams |= self.get_trigrams(name)
+            self.db.executemany("INSERT INTO trigram VALUES (?, ?)", [(trigram, search_result["id"]) for trigram in trigrams])
+            self.db.executemany("INSERT INTO offer VALUES (?, ?, ?)", [(search_result["id"], offer["monetization_type"], offer["package_short_name"]) for offer in search_result.get("offers", [])])
+
+        self.delete_unlisted_titles(previous_title_id_list)
+        self.db.execute("INSERT OR REPLACE INTO page VALUES (?, ?, ?)", (page, page_hash, time.time()))
+        self.db.commit()
+        return True
+
+    def delete_title(self, title_id: int):
+        self.db.execute("DELETE FROM title WHERE id = ?", (title_id,))
+        self.db.execute("DELETE FROM trigram WHERE title_id = ?", (title_id,))
+        self.db.execute("DELETE FROM offer WHERE title_id = ?", (title_id,))
+
+    def delete_unlisted_titles(self, title_id_list: list):
+        """delete the titles that are no longer listed by any page"""
+        for title_id in title_id_list:
+            if self.db.execute("SELECT 1 FROM page_title WHERE title_id = ?", (title_id,)).fetchone() == None:
+                self.delete_title(title_id)
+
+    def sync(self, language: str = None, content_type_list: list = None) -> int:
+        """download the popular catalog page by page, return the number of pages updated"""
+
+        if language == None:
+            language = default_language
+
+        if content_type_list == None:
+            content_type_list = default_content_type_list
+
+        updated_page_count = 0
+        page = 1
+        total_pages = 1
+        while page <= total_pages:
+            results = get_popular_titles(language, content_type_list, page=page, page_size=default_catalog_page_size)
+            total_pages = results.get("total_pages", page)
+            if self.update_page(page, results["items"]):
+                updated_page_count += 1
+            page += 1
+
+        # pages beyond the end of the catalog
+        title_id_list = [ title_id for (title_id,) in self.db.execute("SELECT title_id FROM page_title WHERE page > ?", (total_pages,)) ]
+        self.db.execute("DELETE FROM page_title WHERE page > ?", (total_pages,))
+        self.delete_unlisted_titles(title_id_list)
+        self.db.execute("DELETE FROM page WHERE page > ?", (total_pages,))
+        self.db.commit()
+
+        return updated_page_count
+
+    def sync_from_file(self, filename: str) -> int:
+        """load captured responses (one per line, as JSON or python literals like movie.txt), return the number of pages updated"""
+        updated_page_count = 0
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    results = json.loads(line)
+                except ValueError:
+                    results = ast.literal_eval(line)
+                if isinstance(results, dict) and "items" in results:
+                    if self.update_page(results.get("page", 1), results["items"]):
+                        updated_page_count += 1
+        return updated_page_count
+
+    def get_search_results(self, query: str) -> list:
+        """titles sharing the most trigrams with the query, as search results"""
+        trigrams = list(self.get_trigrams(query))
+        if len(trigrams) == 0:
+            return []
+
+        rows = self.db.execute(
+            "SELECT title_id FROM trigram WHERE trigram IN (%s) GROUP BY title_id ORDER BY COUNT(*) DESC LIMIT ?" % ",".join("?" * len(trigrams)),
+            trigrams + [default_catalog_max_candidates]
+        ).fetchall()
+
+        search_result_list = []
+        for (title_id,) in rows:
+            (title, original_release_year, object_type, names) = self.db.execute("SELECT title, original_release_year, object_type, names FROM title WHERE id = ?", (title_id,)).fetchone()
+            offers = [ { "monetization_type": m, "package_short_name": p } for (m, p) in self.db.execute("SELECT monetization_type, package_short_name FROM offer WHERE title_id = ?", (title_id,)) ]
+            search_result_list.append({
+                "id": title_id,
+                "title": title,
+                "original_release_year": original_release_year,
+                "object_type": object_type,
+                "alternative_titles": json.loads(names)[1:],
+                "offers": offers,
+            })
+
+        return search_result_list
+
+    def search_content(self, query: str, min_fuzz_ratio: int = None):
+        return match_search_results(query, self.get_search_results(query), min_fuzz_ratio)
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session(pool_size: int = None, max_retries: int = None) -> requests.Session:
+    """HTTP session shared by all the searches: pooled keep-alive connections, retries with exponential backoff on 429/5xx"""
+    global http_session
+
+    with http_session_lock:
+        if http_session == None:
+            retry = Retry(
+                total = max_retries if max_retries != None else default_max_retries,
+                backoff_factor = default_retry_backoff_factor,
+                status_forcelist = [429, 500, 502, 503, 504],
+                allowed_methods = ["GET"],
+                respect_retry_after_header = True,
+                raise_on_status = False,
+            )
+            adapter = HTTPAdapter(pool_maxsize=pool_size or default_max_workers, pool_block=True, max_retries=retry)
+            http_session = requests.Session()
+            http_session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+
+    return http_session
+
 ############################
 # functions
 ############################
 
 def get_title_year_from_filename(filename: str) -> tuple:
-    filename = os.path.basename(filename)
-
-    # default values
-    title = filename
-    year = None
-
-    filename = re.sub(r"[\(\)\.]", " ", filename)
-    filename = re.sub(" +", " ", filename)
-    filename = re.sub(" *(the)* *movie", " ", filename, flags=re.IGNORECASE)
-
-    m = re.match("(.+) ([0-9]{4}) ", filename)
-    if m:
-        title = m.group(1)
-        title = title.replace(".", " ")
-        year = int(m.group(2))
-
-    return (title, year)
-
-def search_content(query: str, language: str = None, content_type_list: list = None, min_fuzz_ratio: int = None) -> list:
+    info = parse_filename(filename)
+    return (info.title, info.year)
 
-    if language == None:
-        language = default_language
-
-    if content_type_list == None:
-        content_type_list = default_content_type_list
-
-    if min_fuzz_ratio == None :
-        min_fuzz_ratio = default_min_fuzz_ratio
+def get_popular_titles(language: str, content_type_list: list, query: str = None, page: int = 1, page_size: int = 5) -> dict:
+    """one page of the popular titles of the providers, matching the query if any"""
 
     body = {
-        "query": query,
         "content_types": content_type_list,
         "monetization_types": default_monetization_type_list,
         "providers": default_provider_list,
         "enable_provider_filter": True,
         "matching_offers_only": True,
         "is_upcoming": False,
-        "page": 1,
-        "page_size": 5,
+        "page": page,
+        "page_size": page_size,
     }
+    if query != None:
+        body["query"] = query
 
     payload = {
         "language": language,
         "body": json.dumps(body)
     }
 
-    r = requests.get(search_url, params=payload)
+    rate_limiter.wait(search_url)
+    r = get_http_session().get(search_url, params=payload)
 
     if r.status_code != 200:
         raise Exception(f"ERROR {r.status_code}: {r.content}")
     
-    results = r.json()
+    return r.json()
+
+def fetch_search_results(query: str, language: str = None, content_type_list: list = None) -> list:
+
+    if language == None:
+        language = default_language
+
+    if content_type_list == None:
+        content_type_list = default_content_type_list
+
+    if search_cache:
+        cache_key = SearchCache.get_key(query, language, content_type_list, default_provider_list, default_monetization_type_list)
+        search_result_list = search_cache.get(cache_key)
+        if search_result_list != None:
+            return search_result_list
+
+    results = get_popular_titles(language, content_type_list, query=query)
     search_result_list = results["items"]
-    content_list = []
-    
-    for search_result in search_result_list:
+
+    if search_cache:
+        search_cache.set(cache_key, search_result_list)
+
+    return search_result_list
+
+def get_search_result_titles(search_result: dict) -> list:
+    """all the titles of a search result: title, original title and alternative titles"""
+    title_list = [search_result["title"]]
+    if search_result.get("original_title"):
+        title_list.append(search_result["original_title"])
+    for alternative_title in search_result.get("alternative_titles") or []:
+        title_list.append(alternative_title if isinstance(alternative_title, str) else alternative_title.get("title", ""))
+    return title_list
+
+def match_search_results(query: str, search_result_list: list, min_fuzz_ratio: int = None):
+    """score the search results against the query, yield the matching content as it is found"""
+
+    if min_fuzz_ratio == None :
+        min_fuzz_ratio = default_min_fuzz_ratio
+
+    # normalize once (lower case, no punctuation), then score the query against all titles in one batch
+    choice_list = []
+    choice_search_result_list = []
+    for (index, search_result) in enumerate(search_result_list):
+        for title in get_search_result_titles(search_result):
+            choice_list.append(utils.default_process(title))
+            choice_search_result_list.append(index)
+
+    ratio_list = {}
+    for (choice, ratio, choice_index) in process.extract(utils.default_process(query), choice_list, scorer=fuzz.ratio, processor=None, score_cutoff=min_fuzz_ratio, limit=None):
+        index = choice_search_result_list[choice_index]
+        ratio_list[index] = max(ratio_list.get(index, 0), int(round(ratio)))
+
+    for (index, search_result) in enumerate(search_result_list):
              
         logging.debug("search result : %s (%s) [%s]" % (search_result["title"], search_result["original_release_year"], search_result["object_type"]))
 
-        ratio = fuzz.ratio(search_result["title"], query.lower())
-        logging.debug("fuzz ratio=%s" % ratio)
-        if ratio >= min_fuzz_ratio:
+        if index in ratio_list:
+            ratio = ratio_list[index]
             logging.debug("[content found] ratio of %s >= %s" % (ratio, min_fuzz_ratio))
 
             provider_list = []
@@ -143,24 +447,129 @@ def search_content(query: str, language: str = None, content_type_list: list = N
                     provider_list.append(provider)
                     logging.debug("[provider] %s" % provider)
             
-            content = Content(
+            yield Content(
                 title = search_result["title"],
                 ratio = ratio,
                 type = search_result["object_type"],
                 release_year = search_result["original_release_year"],
                 provider_list = provider_list
             )
-
-            content_list.append(content)
         else:
-            logging.debug("[skipped] ratio of %s < %s" % (ratio, min_fuzz_ratio))
+            logging.debug("[skipped] ratio < %s" % min_fuzz_ratio)
+
+def search_content(query: str, language: str = None, content_type_list: list = None, min_fuzz_ratio: int = None):
+    search_result_list = fetch_search_results(query, language, content_type_list)
+    return match_search_results(query, search_result_list, min_fuzz_ratio)
+
+def search_content_list(query_list, language: str = None, content_type_list: list = None, min_fuzz_ratio: int = None, max_workers: int = None):
+    """search several queries concurrently, yield the content list of each query in the same order
+
+    queries are read from the iterable as searches complete, so only a few results are pending at once"""
+
+    if max_workers == None:
+        max_workers = default_max_workers
+
+    # connection pool sized to the number of workers
+    get_http_session(pool_size=max_workers)
 
-    return content_list
+    def search(query: str) -> list:
+        try:
+            return list(search_content(query, language, content_type_list, min_fuzz_ratio))
+        except Exception as e:
+            # a failed search doesn't stop the whole scan
+            logging.error("search failed for [%s]: %s" % (query, e))
+            return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending_list = deque()
+        for query in query_list:
+            pending_list.append(executor.submit(search, query))
+            if len(pending_list) >= 2 * max_workers:
+                yield pending_list.popleft().result()
+        while pending_list:
+            yield pending_list.popleft().result()
+
+def filter_content_list(content_list, year: int = None, year_match: bool = False):
+    """yield the content available on the providers with its year match flag (None if the file has no year)"""
+
+    for content in content_list:
+        logging.debug("found: %s" % str(content))
+        if len(content.provider_list) > 0:
+            
+            year_matches = None
+            if year != None:
+                year_matches = (year == content.release_year)
             
+            if year_matches or not year_match:
+                yield (content, year_matches)
+
+def format_content_list(content_list, year: int = None, year_match: bool = False):
+    """colored lines of the content available on the providers, yielded as the content is matched"""
+
+    for (content, year_matches) in filter_content_list(content_list, year, year_match):
+        if year_matches == None:
+            color = "cyan"
+        elif year_matches:
+            color = "green"
+        else:
+            color = "yellow"
+        yield colored("\t" + str(content), color)
+
+def get_file_record(filepath: str, title: str, year: int, content_list, year_match: bool = False) -> dict:
+    """machine-readable record of a file and its matched content"""
+    return {
+        "file": filepath,
+        "title": title,
+        "year": year,
+        "content": [ dict(content.to_dict(), year_match=year_matches) for (content, year_matches) in filter_content_list(content_list, year, year_match) ],
+    }
+
+class RecordWriter():
+    """stream the file records to stdout as a JSON array, JSON lines or CSV rows (one row per matched content)"""
+
+    csv_field_list = [ "file", "title", "year", "content_title", "content_type", "content_release_year", "ratio", "year_match", "providers" ]
+
+    def __init__(self, format: str, stream = None):
+        self.format = format
+        self.stream = stream if stream != None else sys.stdout
+        self.record_count = 0
+        if format == "csv":
+            self.csv_writer = csv.DictWriter(self.stream, fieldnames=self.csv_field_list)
+            self.csv_writer.writeheader()
+
+    def write(self, record: dict):
+        if self.format == "json":
+            self.stream.write("[\n" if self.record_count == 0 else ",\n")
+            self.stream.write(json.dumps(record))
+        elif self.format == "ndjson":
+            self.stream.write(json.dumps(record) + "\n")
+        elif self.format == "csv":
+            row = { "file": record["file"], "title": record["title"], "year": record["year"] }
+            if len(record["content"]) == 0:
+                self.csv_writer.writerow(row)
+            for content in record["content"]:
+                self.csv_writer.writerow(dict(row,
+                    content_title = content["title"],
+                    content_type = content["type"],
+                    content_release_year = content["release_year"],
+                    ratio = content["ratio"],
+                    year_match = content["year_match"],
+                    providers = "|".join(content["providers"])
+                ))
+        self.stream.flush()
+        self.record_count += 1
+
+    def close(self):
+        if self.format == "json":
+            self.stream.write("[]\n" if self.record_count == 0 else "\n]\n")
+            self.stream.flush()
+
 ############################
 # main
 ############################
 if __name__ == '__main__':
+    record_writer = None
+    message_stream = sys.stdout
     try:
 
         script_name = os.path.basename(__file__)
@@ -172,6 +581,15 @@ if __name__ == '__main__':
         parser.add_argument('-g', '--lang',       metavar='lang',      type=str,  help='language for search (default=%s)' % default_language)
         parser.add_argument('-t', '--types',      metavar='types',     nargs="+", help='content types for search : movie, show (default=%s)' % str(default_content_type_list))
         parser.add_argument('-y', '--year-match', dest='year_match', action='store_true', help='display only content matching year')
+        parser.add_argument('-w', '--workers',    metavar='workers',   type=int,  help='number of concurrent searches (default=%s)' % default_max_workers)
+        parser.add_argument('-q', '--rate',       metavar='rate',      type=float, help='maximum requests per second (default=%s)' % default_max_requests_per_second)
+        parser.add_argument('-c', '--cache-ttl',  metavar='cache_ttl', type=int,  help='cache duration in seconds of results with offers (default=%s)' % default_cache_ttl)
+        parser.add_argument('-f', '--refresh',    dest='refresh',    action='store_true', help='ignore cached results, search again and update cache')
+        parser.add_argument('-n', '--no-cache',   dest='no_cache',   action='store_true', help='do not use the results cache (%s)' % default_cache_file)
+        parser.add_argument('-o', '--offline',    dest='offline',    action='store_true', help='search in the local providers catalog (%s)' % default_catalog_file)
+        parser.add_argument('-s', '--sync',       dest='sync',       action='store_true', help='update the local providers catalog before searching')
+        parser.add_argument('--sync-from',        metavar='file',      nargs="+", help='update the local providers catalog from captured responses')
+        parser.add_argument('-F', '--format',     metavar='format',    choices=default_output_formats, default=default_output_formats[0], help='output format : %s (default=%s)' % (", ".join(default_output_formats), default_output_formats[0]))
         parser.add_argument('-a', '--all',        dest='all',        action='store_true', help='display all files, even if no content found')
         parser.add_argument('-r', '--recursive',  dest='recursive',  action='store_true', help='recurse in sub folders')
         parser.add_argument('-l', '--log',        dest='log',        action='store_true', help='log to file')
@@ -186,7 +604,10 @@ if __name__ == '__main__':
             logLevel = logging.DEBUG
         else:
             logLevel = logging.INFO            
-        logging.basicConfig(stream=sys.stdout, level=logLevel, format='%(asctime)s - %(levelname)s - %(message)s')
+        # keep stdout for the records in the machine-readable formats, the progress bar is on stderr
+        logStream = sys.stdout if args.format == "text" else sys.stderr
+        message_stream = logStream
+        logging.basicConfig(stream=logStream, level=logLevel, format='%(asctime)s - %(levelname)s - %(message)s')
         logger = logging.getLogger()
 
         if args.log:
@@ -204,41 +625,76 @@ if __name__ == '__main__':
 
             file_list += glob.glob(file_pattern, recursive=args.recursive)
 
-        for filepath in tqdm(sorted(file_list)):
-            logging.debug("%s" % filepath)
-            filepath_without_ext = os.path.splitext(filepath)[0]
-
-            (title, year) = get_title_year_from_filename(filepath_without_ext)
-            logging.debug("title: [%s] year: %s" % (title, year))
-
-            content_list = search_content(query = title, language= args.lang, content_type_list = args.types, min_fuzz_ratio = args.min_ratio)
-
-            output = ""
-
-            for content in content_list:
-                logging.debug("found: %s" % str(content))
-                if len(content.provider_list) > 0:
-                    
-                    year_matches = False
-                    if year == None:
-                        color = "cyan"
-                    elif year == content.release_year:
-                        year_matches = True
-                        color = "green"
-                    else:
-                        color = "yellow"
-                    
-                    if year_matches or not args.year_match:
-                        output += colored("\t" + str(content) + "\n", color)
-
-            if output or args.all:
+        if args.rate:
+            rate_limiter = HostRateLimiter(args.rate)
+
+        if not args.no_cache:
+            search_cache = SearchCache(default_cache_file, ttl=args.cache_ttl, refresh=args.refresh)
+
+        catalog = None
+        if args.offline or args.sync or args.sync_from:
+            catalog = ProviderCatalog(default_catalog_file)
+
+        if args.sync:
+            logging.info("catalog sync: %s pages updated" % catalog.sync(language=args.lang, content_type_list=args.types))
+
+        for sync_filename in args.sync_from or []:
+            logging.info("catalog sync from %s: %s pages updated" % (sync_filename, catalog.sync_from_file(sync_filename)))
+
+        file_list = sorted(file_list)
+
+        def get_title_year_list():
+            for filepath in file_list:
+                logging.debug("%s" % filepath)
+                filepath_without_ext = os.path.splitext(filepath)[0]
+
+                (title, year) = get_title_year_from_filename(filepath_without_ext)
+                logging.debug("title: [%s] year: %s" % (title, year))
+                yield (title, year)
+
+        if args.offline:
+            content_list_iterator = (catalog.search_content(title, min_fuzz_ratio=args.min_ratio) for (title, year) in get_title_year_list())
+        else:
+            content_list_iterator = search_content_list(
+                query_list = (title for (title, year) in get_title_year_list()),
+                language = args.lang,
+                content_type_list = args.types,
+                min_fuzz_ratio = args.min_ratio,
+                max_workers = args.workers
+            )
+
+        if args.format != "text":
+            record_writer = RecordWriter(args.format)
+
+        for (filepath, (title, year), content_list) in tqdm(zip(file_list, get_title_year_list(), content_list_iterator), total=len(file_list)):
+
+            if record_writer:
+                record = get_file_record(filepath, title, year, content_list, args.year_match)
+                if record["content"] or args.all:
+                    with tqdm.external_write_mode():
+                        record_writer.write(record)
+                continue
+
+            filepath_written = False
+            if args.all:
                 tqdm.write(filepath)
-                tqdm.write(output, end="")
-                # content_found = True
+                filepath_written = True
+
+            for line in format_content_list(content_list, year, args.year_match):
+                if not filepath_written:
+                    tqdm.write(filepath)
+                    filepath_written = True
+                tqdm.write(line)
+
+        if record_writer:
+            record_writer.close()
                 
     # catch keyboard interrupt or broken pipe
     except (KeyboardInterrupt) as e:
-        print("\ninterrupted")
+        # terminate the records already written, so that they can still be parsed
+        if record_writer:
+            record_writer.close()
+        print("\ninterrupted", file=message_stream)
         try:
             sys.stdout.close()
         except IOError:
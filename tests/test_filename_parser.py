@@ -0,0 +1,37 @@
+import pytest
+
+from filename_parser import parse_filename
+
+
+@pytest.mark.parametrize("filename, title, year", [
+    ("Fight Club (1999).mkv", "Fight Club", 1999),
+    ("Deadpool 2016.mkv", "Deadpool", 2016),
+    ("2001 A Space Odyssey 1968.mkv", "2001 A Space Odyssey", 1968),
+    ("Blade Runner 2049 (2017).mkv", "Blade Runner 2049", 2017),
+    ("The.Lego.Movie.2014.1080p.BluRay.x264-GRP.mkv", "The Lego", 2014),
+    # tag-like words before the year belong to the title
+    ("The.French.Connection.1971.1080p.mkv", "The French Connection", 1971),
+    ("Charlotte's Web (2006).mkv", "Charlotte's Web", 2006),
+    ("Multi.Facial.1995.MULTI.mkv", "Multi Facial", 1995),
+    # without year, only the trailing tags end the title
+    ("The French Dispatch.mkv", "The French Dispatch", None),
+    ("Extended Family.MULTI.mkv", "Extended Family", None),
+    ("Amelie.FRENCH.DVDRip.XviD-GRP.avi", "Amelie", None),
+    ("Some Film.mkv", "Some Film", None),
+])
+def test_title_year(filename, title, year):
+    info = parse_filename(filename)
+    assert (info.title, info.year) == (title, year)
+
+
+def test_episode_tags():
+    info = parse_filename("Breaking.Bad.S05E14.720p.HDTV.x264.mkv")
+    assert info == ("Breaking Bad", None, 5, 14, "720p", "hdtv")
+
+    info = parse_filename("show.3x07.WEB.mkv")
+    assert (info.title, info.season, info.episode, info.source) == ("show", 3, 7, "web")
+
+
+def test_tags_before_year_are_not_source():
+    info = parse_filename("Charlotte's Web (2006).mkv")
+    assert info.source is None
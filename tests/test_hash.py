@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import OpenSubtitlesDownload as osd
+
+
+def write_file(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.fixture(params=["numpy", "memoryview"])
+def sum_path(request, monkeypatch):
+    if request.param == "numpy":
+        if osd.numpy is None:
+            pytest.skip("numpy is not installed")
+    else:
+        monkeypatch.setattr(osd, "numpy", None)
+    return request.param
+
+
+@pytest.mark.parametrize("name, data", [
+    ("random.bin", os.urandom(1024 * 1024 + 123)),
+    ("ff.bin", b"\xff" * (1024 * 1024)),
+    ("exact.bin", os.urandom(131072)),
+    ("exact_plus_one.bin", os.urandom(131073)),
+])
+def test_hash_file_fast_matches_reference(tmp_path, sum_path, name, data):
+    path = write_file(tmp_path, name, data)
+    assert osd.hashFileFast(path) == osd.hashFile(path)
+
+
+def test_hash_file_fast_too_small(tmp_path, sum_path, monkeypatch):
+    monkeypatch.setattr(osd, "superPrint", lambda *args: None)
+    path = write_file(tmp_path, "small.bin", os.urandom(131071))
+    assert osd.hashFileFast(path) == osd.hashFile(path) == "SizeError"
@@ -0,0 +1,100 @@
+import os
+import ast
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import search_providers
+
+
+def load_movie_results():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "movie.txt")
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            results = ast.literal_eval(line.strip()) if line.strip() else None
+            if isinstance(results, dict) and "items" in results:
+                return results
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.request_list.append((time.monotonic(), self.client_address, parse_qs(urlparse(self.path).query)))
+        if server.status_list:
+            (status, headers) = server.status_list.pop(0)
+            body = b"slow down"
+        else:
+            (status, headers) = (200, {"Content-Type": "application/json"})
+            body = json.dumps(server.payload).encode("utf-8")
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.request_list = []
+    server.status_list = []
+    server.payload = load_movie_results()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(search_providers, "search_url", "http://127.0.0.1:%d/content/titles/fr_FR/popular" % server.server_address[1])
+    monkeypatch.setattr(search_providers, "http_session", None)
+    monkeypatch.setattr(search_providers, "search_cache", None)
+    monkeypatch.setattr(search_providers, "rate_limiter", search_providers.HostRateLimiter(1000))
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_retry_after_429(stand_in):
+    stand_in.status_list.append((429, {"Retry-After": "1"}))
+
+    search_result_list = search_providers.fetch_search_results("fight club")
+
+    assert len(stand_in.request_list) == 2
+    assert stand_in.request_list[1][0] - stand_in.request_list[0][0] >= 0.9
+    assert json.loads(stand_in.request_list[1][2]["body"][0])["query"] == "fight club"
+    assert search_result_list == stand_in.payload["items"]
+    assert search_result_list[0]["title"] == "Fight Club"
+
+
+def test_backoff_on_server_errors(stand_in):
+    stand_in.status_list += [(503, {}), (502, {})]
+
+    search_result_list = search_providers.fetch_search_results("fight club")
+
+    assert len(stand_in.request_list) == 3
+    assert search_result_list == stand_in.payload["items"]
+
+
+def test_retries_exhausted(stand_in):
+    search_providers.get_http_session(max_retries=1)
+    stand_in.status_list += [(429, {"Retry-After": "0"})] * 2
+
+    with pytest.raises(Exception, match="ERROR 429"):
+        search_providers.fetch_search_results("fight club")
+    assert len(stand_in.request_list) == 2
+
+
+def test_connections_are_reused(stand_in):
+    for i in range(5):
+        search_providers.fetch_search_results("fight club")
+
+    assert len(stand_in.request_list) == 5
+    assert len(set(client_address for (t, client_address, query) in stand_in.request_list)) == 1
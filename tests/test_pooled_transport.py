@@ -0,0 +1,87 @@
+import threading
+from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
+from xmlrpc.client import ServerProxy, Fault, ProtocolError
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+import pytest
+
+import OpenSubtitlesDownload as osd
+
+
+class KeepAliveHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = "HTTP/1.1"
+    rpc_paths = ("/xml-rpc",)
+
+    def setup(self):
+        super().setup()
+        self.server.client_address_list.append(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+def fail():
+    raise ValueError("no subtitles")
+
+
+@pytest.fixture
+def xmlrpc_server():
+    server = ThreadingXMLRPCServer(("127.0.0.1", 0), requestHandler=KeepAliveHandler, logRequests=False, allow_none=True)
+    server.client_address_list = []
+    server.register_function(lambda a, b: a + b, "add")
+    server.register_function(fail, "fail")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_proxy(server, transport, path="/xml-rpc"):
+    return ServerProxy("http://127.0.0.1:%d%s" % (server.server_address[1], path), transport=transport)
+
+
+def test_connection_is_reused(xmlrpc_server):
+    transport = osd.PooledTransport(https=False, poolSize=4)
+    proxy = get_proxy(xmlrpc_server, transport)
+
+    assert [proxy.add(i, 1) for i in range(10)] == list(range(1, 11))
+    assert len(xmlrpc_server.client_address_list) == 1
+    assert len(transport.pool) == 1
+
+
+def test_fault_keeps_the_connection(xmlrpc_server):
+    transport = osd.PooledTransport(https=False, poolSize=4)
+    proxy = get_proxy(xmlrpc_server, transport)
+
+    with pytest.raises(Fault):
+        proxy.fail()
+    assert proxy.add(1, 2) == 3
+    assert len(xmlrpc_server.client_address_list) == 1
+
+
+def test_error_response_is_not_reused(xmlrpc_server):
+    transport = osd.PooledTransport(https=False, poolSize=4)
+
+    with pytest.raises(ProtocolError) as e:
+        get_proxy(xmlrpc_server, transport, "/unknown").add(1, 2)
+    assert e.value.errcode == 404
+    assert len(transport.pool) == 0
+
+    assert get_proxy(xmlrpc_server, transport).add(1, 2) == 3
+    assert len(xmlrpc_server.client_address_list) == 2
+
+
+def test_pool_is_shared_by_threads(xmlrpc_server):
+    transport = osd.PooledTransport(https=False, poolSize=4)
+    proxy = get_proxy(xmlrpc_server, transport)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(lambda i: proxy.add(i, 1), range(100))) == list(range(1, 101))
+    assert len(transport.pool) <= 4
+    assert len(xmlrpc_server.client_address_list) <= 4
@@ -0,0 +1,52 @@
+import sqlite3
+
+import search_providers
+
+
+def title(title_id, name):
+    return {"id": title_id, "title": name, "object_type": "movie", "original_release_year": 2000, "offers": [{"monetization_type": "flatrate", "package_short_name": "nfx"}]}
+
+
+def title_ids(catalog):
+    return sorted(title_id for (title_id,) in catalog.db.execute("SELECT id FROM title"))
+
+
+def test_title_moving_between_pages_is_kept(tmp_path):
+    catalog = search_providers.ProviderCatalog(str(tmp_path / "catalog.db"))
+    catalog.update_page(1, [title(1, "Alien"), title(2, "Heat")])
+    catalog.update_page(2, [title(3, "Ronin"), title(4, "Brazil")])
+
+    # ranks shift during a sync: title 4 is listed by both pages
+    assert catalog.update_page(1, [title(1, "Alien"), title(4, "Brazil")])
+    assert not catalog.update_page(2, [title(3, "Ronin"), title(4, "Brazil")])
+    assert title_ids(catalog) == [1, 3, 4]
+
+    # page 1 no longer lists it, page 2 (unchanged) still does
+    assert catalog.update_page(1, [title(1, "Alien"), title(5, "Fargo")])
+    assert not catalog.update_page(2, [title(3, "Ronin"), title(4, "Brazil")])
+    assert title_ids(catalog) == [1, 3, 4, 5]
+    assert [result["id"] for result in catalog.get_search_results("Brazil")][0] == 4
+
+    # listed by no page anymore
+    assert catalog.update_page(2, [title(3, "Ronin")])
+    assert title_ids(catalog) == [1, 3, 5]
+    assert catalog.db.execute("SELECT COUNT(*) FROM offer WHERE title_id = 4").fetchone()[0] == 0
+
+
+def test_catalog_without_page_title_is_migrated(tmp_path):
+    filename = str(tmp_path / "catalog.db")
+    db = sqlite3.connect(filename)
+    db.executescript("""
+        CREATE TABLE page (page INTEGER PRIMARY KEY, hash TEXT, synced REAL);
+        CREATE TABLE title (id INTEGER PRIMARY KEY, page INTEGER, title TEXT, original_release_year INTEGER, object_type TEXT, names TEXT);
+        INSERT INTO title VALUES (1, 1, 'Alien', 1979, 'movie', '["Alien"]');
+        INSERT INTO title VALUES (2, 2, 'Heat', 1995, 'movie', '["Heat"]');
+    """)
+    db.commit()
+    db.close()
+
+    catalog = search_providers.ProviderCatalog(filename)
+    assert sorted(catalog.db.execute("SELECT page, title_id FROM page_title")) == [(1, 1), (2, 2)]
+
+    catalog.update_page(1, [title(3, "Ronin")])
+    assert title_ids(catalog) == [2, 3]
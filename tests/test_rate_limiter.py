@@ -0,0 +1,98 @@
+import types
+
+import pytest
+
+import OpenSubtitlesDownload as osd
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(osd, "time", types.SimpleNamespace(time=clock.time, sleep=clock.sleep))
+    return clock
+
+
+@pytest.fixture
+def limiter(tmp_path, clock):
+    return osd.RateLimiter(str(tmp_path / "ratelimit.json"))
+
+
+def max_in_window(times, period):
+    return max(sum(1 for t in times if start <= t < start + period) for start in times)
+
+
+def test_requests_never_exceed_the_quota_in_a_window(limiter, clock):
+    times = []
+    for i in range(200):
+        limiter.acquire()
+        times.append(clock.now)
+        clock.now += 0.01
+    assert max_in_window(times, osd.osd_limit_requests_period) == osd.osd_limit_requests
+
+
+def test_downloads_never_exceed_the_quota_in_a_window(limiter, clock, monkeypatch):
+    monkeypatch.setattr(osd, "opt_rate_limit_max_wait", osd.osd_limit_downloads_period)
+    times = []
+    while len(times) < 2 * osd.osd_limit_downloads:
+        downloads = limiter.reserveDownloads(7)
+        times += [clock.now] * downloads
+        clock.now += 60
+    assert max_in_window(times, osd.osd_limit_downloads_period) == osd.osd_limit_downloads
+
+
+def test_reserve_downloads_shrinks_to_what_is_left(limiter, clock):
+    assert limiter.reserveDownloads(osd.osd_limit_downloads - 15) == osd.osd_limit_downloads - 15
+    assert limiter.reserveDownloads(20) == 15
+    clock.now += 60
+    with pytest.raises(osd.RateLimitError, match="next download possible in 1440 minutes"):
+        limiter.reserveDownloads(20)
+
+
+def test_block_delays_the_next_request(limiter, clock):
+    limiter.acquire()
+    limiter.block()
+    start = clock.now
+    limiter.acquire()
+    assert clock.now - start == pytest.approx(osd.osd_limit_requests_period)
+
+    limiter.block(30)
+    start = clock.now
+    limiter.acquire()
+    assert clock.now - start == pytest.approx(30)
+
+
+def test_retry_after_header():
+    error = osd.ProtocolError("host/xml-rpc", 429, "Too Many Requests", {"retry-after": "12"})
+    assert osd.retryAfter(error) == 12
+    error = osd.ProtocolError("host/xml-rpc", 429, "Too Many Requests", {})
+    assert osd.retryAfter(error) is None
+
+
+def test_download_batch_shrinks_to_the_quota(limiter, clock, monkeypatch):
+    requested = []
+    monkeypatch.setattr(osd, "rateLimiter", limiter)
+    monkeypatch.setattr(osd, "session", {"token": "token"}, raising=False)
+    monkeypatch.setattr(osd, "journal", None, raising=False)
+    monkeypatch.setattr(osd, "superPrint", lambda *args: None)
+    monkeypatch.setattr(osd, "writeSubtitles", lambda data, path, encoding: len(data))
+    monkeypatch.setattr(osd, "osdRequest", lambda method, token, subIDList: requested.append(subIDList) or
+                        {"data": [{"idsubtitlefile": subID, "data": "data"} for subID in subIDList]})
+
+    limiter.reserveDownloads(osd.osd_limit_downloads - 15)
+    downloadList = [{"id": str(i), "language": "eng", "title": "title", "path": "path", "encoding": "utf-8", "video": "video"} for i in range(100, 120)]
+    failedList = osd.downloadSubtitlesBatch(downloadList)
+
+    assert len(requested) == 1 and len(requested[0]) == 15
+    assert sorted(download["id"] for download in failedList) == [str(i) for i in range(115, 120)]